@@ -2,63 +2,173 @@
 
 from tools import toolsNets
 from tools import dictionariesSL2P
-from tools import SL2PV0 as algorithm
+from tools import registrySL2P
+from tools import angleFields
+from tools import profileSL2P
 import numpy
-from datetime import datetime
+import logging
 from tools import read_sentinel2_safe_image # Used for legacy SAFE processing modes
-from skimage.transform import resize # *** CHANGE: New import for robust resizing of angle grids ***
+from tools import resampleSL2P
+
+logger = logging.getLogger(__name__)
 
 # main SL2P function (Entry point for processing)
-def SL2P(sl2p_inp,variableName,imageCollectionName,outPath=None):
-    networkOptions= dictionariesSL2P.make_net_options()
-    collectionOptions = (dictionariesSL2P.make_collection_options(algorithm))
-    netOptions=networkOptions[variableName][imageCollectionName]
-    colOptions=collectionOptions[imageCollectionName]
+# Both flags are uint8 (0 valid, 1 flagged) whether or not a mask is given.
+# If mask (boolean rows x cols, see make_valid_mask) is given only the valid pixels are run
+# through the nets; masked pixels get the outputNodata value and the maskedFlag in both flags.
+# backend selects the inference kernel (see toolsNets.BACKENDS).
+# With ensemble=True all numNets member networks are evaluated (toolsNets.applyEnsemble): the
+# estimate and uncertainty are the ensemble means and variableName+'_spread' holds the
+# standard deviation of the member estimates.
+# inputFlag: optional precomputed (rows x cols) input flag (invalidInput of the whole image,
+# e.g. from cacheSL2P), used instead of recomputing the domain check.
+def SL2P(sl2p_inp,variableName,imageCollectionName,outPath=None,mask=None,backend='float64',ensemble=False,inputFlag=None):
+    netOptions=registrySL2P.get_net_options(variableName,imageCollectionName)
+    colOptions={'name':imageCollectionName,'sl2pDomain':registrySL2P.get_domain(imageCollectionName)}
     
     # Prepare SL2P networks (loads NN weights based on collectionOptions)
-    # *** CHANGE: Updated variable names for clarity (SL2P -> SL2P_nets) ***
-    # This prevents naming conflicts with the function name itself.
-    SL2P_nets, errorsSL2P_nets = makeModel(algorithm,imageCollectionName,variableName) 
+    # *** CHANGE: Networks come from the process-wide registry ***
+    # Only the networks of the requested variable are built, once per process.
+    SL2P_nets, errorsSL2P_nets = registrySL2P.get_nets(imageCollectionName,variableName)
 
     # *** CHANGE: Capture dimensions (bands, rows, cols) ***
     # Necessary for reshaping the output back into a 2D image after neural network inference.
     bands, rows, cols = sl2p_inp.shape
+    if mask is not None:
+        sl2p_inp=gather(sl2p_inp,mask)
         
     # generate sl2p input data flag (Domain check)
-    inputs_flag=invalidInput(sl2p_inp,netOptions,colOptions)
+    with profileSL2P.stage('invalidInput', sl2p_inp[0].size):
+        inputs_flag=(invalidInput(sl2p_inp,netOptions,colOptions) if inputFlag is None else gatherFlag(inputFlag,mask)).astype(numpy.uint8)
         
     # run SL2P (NN Inference)
-    print('Run SL2P...\nSL2P start: %s' %(datetime.now()))
+    logger.debug('Run SL2P for %s on %d pixels', variableName, sl2p_inp[0].size)
         
     # *** CHANGE: Passing the 3D array directly ***
     # The original logic sometimes struggled with input shapes; this ensures 
     # the 3D stack is passed correctly to the wrapper.
-    estimate    =toolsNets.wrapperNNets(SL2P_nets    ,netOptions,sl2p_inp)
-    uncertainty=toolsNets.wrapperNNets(errorsSL2P_nets,netOptions,sl2p_inp)
-    print('SL2P end: %s' %(datetime.now()))
+    with profileSL2P.stage('inference', sl2p_inp[0].size):
+        if ensemble:
+            estimate,spread=toolsNets.applyEnsemble(sl2p_inp,SL2P_nets,backend)
+            uncertainty=toolsNets.applyEnsemble(sl2p_inp,errorsSL2P_nets,backend)[0]
+        else:
+            estimate    =toolsNets.applyNet(sl2p_inp,SL2P_nets,backend)
+            uncertainty=toolsNets.applyNet(sl2p_inp,errorsSL2P_nets,backend)
         
+    # generate sl2p output product flag (Range check)
+    with profileSL2P.stage('invalidOutput', estimate.size):
+        output_flag=invalidOutput(estimate,variableName)
+
+    # Masked pixels were skipped: scatter the valid pixels back on the image grid
+    if mask is not None:
+        estimate=scatter(estimate,mask,'outputNodata')
+        uncertainty=scatter(uncertainty,mask,'outputNodata')
+        inputs_flag=scatter(inputs_flag,mask,'maskedFlag',numpy.uint8)
+        output_flag=scatter(output_flag,mask,'maskedFlag',numpy.uint8)
+        if ensemble:
+            spread=scatter(spread,mask,'outputNodata')
+
     # *** CHANGE: Reshape outputs back to 2D image format ***
     # The NN output is a flat 1D array; we must map it back to (rows x cols).
     estimate_reshaped = estimate.reshape(rows, cols)
     uncertainty_reshaped = uncertainty.reshape(rows, cols)
-        
-    # generate sl2p output product flag (Range check)
-    output_flag=invalidOutput(estimate_reshaped,variableName)
-    print('Done')
+    output_flag = output_flag.reshape(rows, cols)
     # *** CHANGE: Return dictionary uses reshaped 2D arrays ***
-    return {
+    varmap = {
         variableName:estimate_reshaped,
         variableName+'_uncertainty':uncertainty_reshaped,
         'sl2p_inputFlag':inputs_flag,
         'sl2p_outputFlag':output_flag
     }
+    if ensemble:
+        varmap[variableName+'_spread']=spread.reshape(rows, cols)
+    return varmap
+
+# run SL2P for several variables of a collection in one pass over the input.
+# sl2p_inp is prepared once (prepare_sl2p_inp with any of the variables, the input bands and
+# scaling are shared within a collection); the estimate and error nets of all variables are
+# evaluated together and a single input flag is computed.
+# ensemble=True evaluates all member networks of every variable as in SL2P (one batched
+# applyEnsemble call per variable and net) and adds the variableName+'_spread' layers.
+# inputFlag: optional precomputed input flag, as in SL2P.
+def SL2P_multi(sl2p_inp,imageCollectionName,variables=None,mask=None,backend='float64',ensemble=False,inputFlag=None):
+    if variables is None:
+        variables=list(dictionariesSL2P.make_outputParams().keys())
+    netOptions=[registrySL2P.get_net_options(variableName,imageCollectionName) for variableName in variables]
+    for options in netOptions[1:]:
+        if any(options[key]!=netOptions[0][key] for key in ['inputBands','inputScaling','inputOffset']):
+            raise ValueError('Variables %s do not share the input bands of %s' % (variables,imageCollectionName))
+    colOptions={'name':imageCollectionName,'sl2pDomain':registrySL2P.get_domain(imageCollectionName)}
+    if mask is not None:
+        sl2p_inp=gather(sl2p_inp,mask)
+
+    # generate sl2p input data flag (Domain check), shared by all variables
+    with profileSL2P.stage('invalidInput', sl2p_inp[0].size):
+        inputs_flag=(invalidInput(sl2p_inp,netOptions[0],colOptions) if inputFlag is None else gatherFlag(inputFlag,mask)).astype(numpy.uint8)
+
+    # run SL2P (NN Inference): estimate and error nets of every variable at once
+    logger.debug('Run SL2P for %s on %d pixels', ', '.join(variables), sl2p_inp[0].size)
+    nets=[]
+    for variableName in variables:
+        nets.extend(registrySL2P.get_nets(imageCollectionName,variableName))
+    with profileSL2P.stage('inference', sl2p_inp[0].size):
+        if ensemble:
+            outputs=[toolsNets.applyEnsemble(sl2p_inp,net,backend) for net in nets]
+            spreads=[spread for _,spread in outputs[0::2]]
+            outputs=[mean for mean,_ in outputs]
+        else:
+            outputs=toolsNets.applyNets(sl2p_inp,nets,backend)
+    estimates,uncertainties=outputs[0::2],outputs[1::2]
+
+    varmap={'sl2p_inputFlag':inputs_flag}
+    for index,variableName in enumerate(variables):
+        varmap[variableName]=estimates[index]
+        varmap[variableName+'_uncertainty']=uncertainties[index]
+        if ensemble:
+            varmap[variableName+'_spread']=spreads[index]
+        # generate sl2p output product flag (Range check)
+        with profileSL2P.stage('invalidOutput', estimates[index].size):
+            varmap[variableName+'_sl2p_outputFlag']=invalidOutput(estimates[index],variableName)
+    if mask is not None:
+        for key,value in varmap.items():
+            varmap[key]=scatter(value,mask,'maskedFlag',numpy.uint8) if key.endswith('Flag') else scatter(value,mask,'outputNodata')
+    return varmap
+
+# build the boolean (rows x cols) mask of the pixels to be processed from a prepared s2 dict
+# (call after prepare_sl2p_inp, which resamples SCL to the band grid): masks nodata in any
+# input band, the FORCE QAI bits and the L2A SCL classes set in make_mask_options
+def make_valid_mask(s2,variableName,imageCollectionName):
+    maskOptions=dictionariesSL2P.make_mask_options()
+    netOptions=registrySL2P.get_net_options(variableName,imageCollectionName)
+    bands=[band for band in netOptions['inputBands'] if band.startswith('B')]
+    mask=numpy.ones(s2[bands[0]].shape,dtype=bool)
+    for band in bands:
+        mask&=s2[band]!=maskOptions['inputNodata']
+    if 'QAI' in s2:
+        mask&=(s2['QAI'].astype(numpy.int32) & maskOptions['qaiInvalidBits'])==0
+    if 'SCL' in s2:
+        mask&=~numpy.isin(s2['SCL'],maskOptions['sclInvalidClasses'])
+    logger.debug('Valid pixels: %d of %d', mask.sum(), mask.size)
+    return mask
+
+# select the valid pixels of a (bands x rows x cols) input as a (bands x 1 x pixels) input
+def gather(sl2p_inp,mask):
+    return sl2p_inp[:,mask][:,None,:]
 
-# makeModel remains unchanged as it handles network loading from GEE assets (or local copies)
-def makeModel(algorithm,imageCollectionName,variableName):
-    collectionOptions = (dictionariesSL2P.make_collection_options(algorithm))
-    colOptions=collectionOptions[imageCollectionName]
-    networkOptions= dictionariesSL2P.make_net_options()
-    netOptions=networkOptions[variableName][imageCollectionName]
+# select the valid pixels of a precomputed (rows x cols) input flag as the flag of gather(sl2p_inp,mask)
+def gatherFlag(inputFlag,mask):
+    return numpy.array(inputFlag,dtype=bool) if mask is None else numpy.asarray(inputFlag)[mask][None,:]
+
+# place per-pixel values of the valid pixels back on the (rows x cols) grid; masked
+# pixels get the make_mask_options value named fill
+def scatter(values,mask,fill,dtype=numpy.float64):
+    image=numpy.full(mask.shape,dictionariesSL2P.make_mask_options()[fill],dtype=dtype)
+    image[mask]=values.ravel()
+    return image
+
+# makeModel builds the networks of all variables of a collection (SL2P itself uses registrySL2P.get_nets)
+def makeModel(imageCollectionName,variableName):
+    colOptions=registrySL2P.get_collection_options(imageCollectionName)
 
     ## Compute numNets
     numNets =len({k: v for k, v in (colOptions["Network_Ind"]['features'][0]['properties']).items() if k != 'Feature Index'})
@@ -69,93 +179,104 @@ def makeModel(algorithm,imageCollectionName,variableName):
 
 
 # prepare the sentinel-2 data (dict) to be inputed to sl2p
-def prepare_sl2p_inp(s2,variableName,imageCollectionName):
-    networkOptions= dictionariesSL2P.make_net_options()
-    netOptions=networkOptions[variableName][imageCollectionName]
+# out: optional caller-provided float32 (bands, rows, cols) buffer to write the input into
+def prepare_sl2p_inp(s2,variableName,imageCollectionName,out=None):
+    with profileSL2P.stage('prepare') as counter:
+        out=_prepare_sl2p_inp(s2,variableName,imageCollectionName,out)
+        counter['pixels']=out[0].size
+    return out
+
+def _prepare_sl2p_inp(s2,variableName,imageCollectionName,out):
+    netOptions=registrySL2P.get_net_options(variableName,imageCollectionName)
     
     # *** CHANGE: Explicit target shape determination ***
-    # Instead of assuming B03, we now look for B02 (the 10m anchor) to ensure alignment 
-    # with high-resolution FORCE data.
-    target_shape = s2['B02'].shape
+    # The first reflectance band of the network sets the grid, so readers only need to
+    # provide the bands the network uses (e.g. read_s2_force with bands=inputBands).
+    target_shape = s2[[band for band in netOptions['inputBands'] if band.startswith('B')][0]].shape
     
-    # --- ANGLE RESAMPLING FIX (Handles upscaling for custom modes) ---
-    # Only resize if the mode is NOT one of the custom modes, OR if the shapes don't match.
-    # We rely on the reader to pass the correct angle arrays.
-    
-    # *** CHANGE: REFACTORED ANGLE RESAMPLING FIX ***
-    # The original code assumed a standard upscaling factor. Our new version:
-    # 1. Checks if the angles (22x22) actually need resampling.
-    # 2. Uses skimage.transform.resize for stability (prevents MemoryErrors).
-    # 3. Includes a check for the Scene Classification Layer (SCL).
-    if s2['SZA'].shape != target_shape:
-        print(f'Resampling angles from {s2["SZA"].shape} to {target_shape}...')
-        
-        # Calculate dynamic factor based on current vs target dimensions
-        factor_y = float(target_shape[0]) / s2['SZA'].shape[0]
-        factor_x = float(target_shape[1]) / s2['SZA'].shape[1]
-        
-        # Resample solar and view angles using bilinear interpolation (order=1)
-        for key in ['SZA', 'SAA', 'VZA', 'VAA']:
-            if key in s2:
-                s2[key] = resize(s2[key], target_shape, order=1, preserve_range=True, anti_aliasing=False)
-        
-        # Nearest neighbor interpolation (order=0) for discrete classification masks
-        if 'SCL' in s2:
-             s2['SCL'] = resize(s2['SCL'], target_shape, order=0, preserve_range=True, anti_aliasing=False).astype(numpy.uint8)
+    # --- GEOMETRY (cosSZA, cosVZA, cosRAA) ---
+    # *** CHANGE: Cosines are computed on the native angle grid and only the three cosines are interpolated ***
+    # Angles vary smoothly over kilometres: computing RAA/deg2rad/cos on a coarse grid (e.g. the 23x23
+    # XML grid or FORCE angle rasters) and interpolating the cosines (bilinear, order=1) avoids full
+    # resolution angle arrays and interpolating azimuths across the 0/360 wrap.
+    # Readers may also provide the cosines directly (e.g. read_s2_force with a window).
+    if not all(key in s2 for key in ['cosSZA', 'cosVZA', 'cosRAA']):
+        logger.debug('Computing cosSZA, cosVZA and cosRAA')
+        cosines = angleFields.cosine_grids(s2['SZA'], s2['SAA'], s2['VZA'], s2['VAA'])
+        if s2['SZA'].shape != target_shape:
+            logger.debug('Interpolating cosines from %s to %s', s2['SZA'].shape, target_shape)
+            cosines = {key: angleFields.interp_window(grid, target_shape) for key, grid in cosines.items()}
+        s2.update(cosines)
 
-    else:
-        print(f'Skipping resampling: Angle shapes already matched (e.g., FORCE TIF).')
-        
-    # --- END ANGLE RESAMPLING FIX ---
-    
-    #compute Relative Azimuth angle (RAA) and Cosines
-    s2['RAA']=numpy.absolute(s2['SAA']-s2['VAA'])
-    print('Computing cosSZA, cosVZA and cosRAA')
-    s2['cosSZA']=numpy.cos(numpy.deg2rad(s2['SZA']))
-    s2['cosVZA']=numpy.cos(numpy.deg2rad(s2['VZA']))
-    s2['cosRAA']=numpy.cos(numpy.deg2rad(s2['RAA']))
+    # Mode resampling (most frequent class) for discrete classification masks
+    if 'SCL' in s2 and s2['SCL'].shape != target_shape:
+        s2['SCL'] = resampleSL2P.resample_to_shape(s2['SCL'], target_shape, 'class', numpy.uint8)
     
     # select sl2p input bands and scale
-    print('Scaling Sentinel-2 bands\nSelecting sl2p input bands')
-    sl2p_inp = {}
+    logger.debug('Scaling and selecting the sl2p input bands')
     
-# *** CHANGE: Robust scaling loop ***
-    # Replaced dictionary.update() with specific key assignment to ensure 
-    # all required input features (including calculated cosines) are captured.
+    # *** CHANGE: Bands are scaled straight into one preallocated (bands, rows, cols) float32 buffer ***
+    # This replaces the dict of scaled arrays plus numpy.stack (two extra copies of the stack).
+    # The network input normalization (inpSlope/inpOffset) is folded into the first layer
+    # weights by toolsNets.foldNet, so the buffer is not rescaled again during inference.
+    shape = (len(netOptions['inputBands']),) + tuple(target_shape)
+    if out is None:
+        out = numpy.empty(shape, dtype=numpy.float32)
+    elif out.shape != shape or out.dtype != numpy.float32:
+        raise ValueError(f"out must be a float32 array of shape {shape}, got {out.dtype} {out.shape}")
+
     for band_id, band in enumerate(netOptions['inputBands']):
         band_data = s2.get(band)
         
         if band_data is None:
              raise ValueError(f"Required band/angle {band} not found in input dictionary.")
 
-        band_data = band_data.astype(numpy.float32)
-        # Applying scaling/offset as defined in dictionariesSL2P.py
-        scaled_band = (band_data + netOptions['inputOffset'][band_id]) * netOptions['inputScaling'][band_id]
-        sl2p_inp[band] = scaled_band
-
-    # *** CHANGE: Diagnostic Shape Check ***
-    # This block was added to troubleshoot the common 'mismatched shape' error during stacking.
-    print('\n--- Stacking Input Arrays ---')
-    sl2p_inp = numpy.stack([sl2p_inp[k] for k in netOptions['inputBands']])
-    print('Done!')
-    return sl2p_inp
+        # Applying scaling/offset as defined in dictionariesSL2P.py, in place: (band + offset) * scaling
+        numpy.add(band_data, netOptions['inputOffset'][band_id], out=out[band_id], dtype=numpy.float32)
+        numpy.multiply(out[band_id], netOptions['inputScaling'][band_id], out=out[band_id])
+
+    return out
     
-# invalidInput and invalidOutput remain unchanged (standard domain and range checks)
+# compile the SL2P domain codes (one decimal digit per reflectance band, band i at 10**i)
+# into a dense boolean lookup table. Digits above the largest digit of a band in the domain
+# all map to one extra "out of domain" slot, which keeps the table small (8.3 MB for the
+# 8 band 20m domain). remap[i][digit] gives the table offset of a digit of band i.
+def compileDomain(sl2pDomain,numBands):
+    digits=numpy.array([(numpy.asarray(sl2pDomain)//10**i)%10 for i in range(numBands)],dtype=numpy.int64)
+    radix=digits.max(axis=1)+2
+    stride=numpy.concatenate([[1],numpy.cumprod(radix[:-1])])
+    remap=numpy.array([numpy.minimum(numpy.arange(10),radix[i]-1)*stride[i] for i in range(numBands)],dtype=numpy.int32)
+    lut=numpy.zeros(int(numpy.prod(radix)),dtype=bool)
+    lut[numpy.sum(digits*stride[:,None],axis=0)]=True
+    return {'remap':remap,'lut':lut}
+
+# invalidInput and invalidOutput: standard domain and range checks
+# *** CHANGE: The domain check uses the lookup table of registrySL2P.get_domain_lut ***
+# Each band is quantized to its decimal digit ceil(image*10)%10 as before, but the digits are
+# packed into one integer index and checked with a single gather instead of building a float
+# code per pixel and numpy.isin against the sorted DomainCode list.
 def invalidInput(image,netOptions,colOptions):
-    print('Generating sl2p input data flag')
+    logger.debug('Generating sl2p input data flag')
     [d0,d1,d2]=image.shape
-    sl2pDomain=numpy.sort(numpy.array([row['properties']['DomainCode'] for row in colOptions["sl2pDomain"]['features']]))
     bandList={b:netOptions["inputBands"].index(b) for b in netOptions["inputBands"] if b.startswith('B')}
-    image=image.reshape(image.shape[0],image.shape[1]*image.shape[2])[list(bandList.values()),:]
+    domain=registrySL2P.get_domain_lut(colOptions['name'],len(bandList))
+    image=image.reshape(image.shape[0],image.shape[1]*image.shape[2])
     
     #Image formatting
-    image_format=numpy.sum((numpy.uint8(numpy.ceil(image*10)%10))* numpy.array([10**value for value in range(len(bandList))])[:,None],axis=0)
+    # the digit is taken with an integer modulo of the quantized band (cheaper than a float %)
+    code=numpy.zeros(d1*d2,dtype=numpy.int32)
+    scaled=numpy.empty(d1*d2,dtype=image.dtype)
+    for index,band in enumerate(bandList.values()):
+        numpy.multiply(image[band],10,out=scaled)
+        digit=numpy.ceil(scaled,out=scaled).astype(numpy.int32)
+        digit%=10
+        code+=domain['remap'][index][digit]
     
     # Comparing image to sl2pDomain
-    flag=numpy.isin(image_format, sl2pDomain,invert=True)
+    flag=~domain['lut'][code]
     return flag.reshape(d1,d2)
 
 def invalidOutput(estimate,variableName):
-    print('Generating sl2p output product flag')
+    logger.debug('Generating sl2p output product flag')
     var_range=dictionariesSL2P.make_outputParams()[variableName]
-    return numpy.where(estimate<var_range['outputOffset'],1,numpy.where(estimate>var_range['outputMax'],1,0))
\ No newline at end of file
+    return ((estimate<var_range['outputOffset'])|(estimate>var_range['outputMax'])).astype(numpy.uint8)
\ No newline at end of file
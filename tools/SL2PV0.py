@@ -1,61 +1,62 @@
 import pickle
+from functools import lru_cache
+
+# nets/ files of the assets (asset_path gives the file of a loader below)
+S2_ESTIMATES = 'nets/s2_sl2p_weiss_or_prosail_NNT3_Single_0_1.pkl'
+S2_ERRORS = 'nets/s2_sl2p_weiss_or_prosail_NNT3_Single_0_1_error.pkl'
+S2_DOMAIN = 'nets/S2_SL2P_WEISS_ORIGINAL_DOMAIN.pkl'
+NETWORK_IND = 'nets/Parameter_file_sl2p.pkl'
+S2_10M_ESTIMATES = 'nets/s2_sl2p_weiss_or_prosail_10m_NNT1_Single_0_1.pkl'
+S2_10M_ERRORS = 'nets/s2_sl2p_weiss_or_prosail_10m_NNT1_Single_0_1_errors.pkl'
+S2_10M_DOMAIN = 'nets/s2_sl2p_weiss_or_prosail_10m_domain.pkl'
+
+
+# unpickle a nets/ asset once per process; collections sharing a file (S2_SR, S2_FORCE,
+# S2_SINGLE_TIF) share the loaded object, which must therefore be treated as read-only
+@lru_cache(maxsize=None)
+def load_asset(path):
+    with open(path, "rb") as fp:   #Pickling
+        file = pickle.load(fp)
+    return file
 
     
  # --------------------
  # Sentinel2 Functions: 
  # --------------------
 def s2_createFeatureCollection_estimates():
-    with open('nets/s2_sl2p_weiss_or_prosail_NNT3_Single_0_1.pkl', "rb") as fp:   #Pickling
-        file = pickle.load(fp)
-    fp.close()    
-    return file
+    return load_asset(S2_ESTIMATES)
 
 def s2_createFeatureCollection_errors():
-    with open('nets/s2_sl2p_weiss_or_prosail_NNT3_Single_0_1_error.pkl', "rb") as fp:   #Pickling
-        file = pickle.load(fp)
-    fp.close()    
-    return file
+    return load_asset(S2_ERRORS)
 
 def s2_createFeatureCollection_domains():
-    with open('nets/S2_SL2P_WEISS_ORIGINAL_DOMAIN.pkl', "rb") as fp:   #Pickling
-        file = pickle.load(fp)
-    fp.close()    
-    return file
+    return load_asset(S2_DOMAIN)
 
 def s2_createFeatureCollection_Network_Ind():
-    with open('nets/Parameter_file_sl2p.pkl', "rb") as fp:   #Pickling
-        file = pickle.load(fp)
-    fp.close()    
-    return file
+    return load_asset(NETWORK_IND)
 
 
  # Same functions as above using 10 m bands:   
 def s2_10m_createFeatureCollection_estimates():
-    with open('nets/s2_sl2p_weiss_or_prosail_10m_NNT1_Single_0_1.pkl', "rb") as fp:   #Pickling
-        file = pickle.load(fp)
-    fp.close()    
-    return file
+    return load_asset(S2_10M_ESTIMATES)
 
 def s2_10m_createFeatureCollection_errors():
-    with open('nets/s2_sl2p_weiss_or_prosail_10m_NNT1_Single_0_1_errors.pkl', "rb") as fp:   #Pickling
-        file = pickle.load(fp)
-    fp.close()    
-    return file
+    return load_asset(S2_10M_ERRORS)
 
 def  s2_10m_createFeatureCollection_domains():
-    with open('nets/s2_sl2p_weiss_or_prosail_10m_domain.pkl', "rb") as fp:   #Pickling
-        file = pickle.load(fp)
-    fp.close()    
-    return file
+    return load_asset(S2_10M_DOMAIN)
 
 def s2_10m_createFeatureCollection_Network_Ind():
-    with open('nets/Parameter_file_sl2p.pkl', "rb") as fp:   #Pickling
-        file = pickle.load(fp)
-    fp.close()    
-    return file    
-    
-
-
- 
-
-
+    return load_asset(NETWORK_IND)
+
+
+# nets/ file read by an asset loader of this module (e.g. the values of make_collection_options(..., load=False))
+def asset_path(loader):
+    return {s2_createFeatureCollection_estimates: S2_ESTIMATES,
+            s2_createFeatureCollection_errors: S2_ERRORS,
+            s2_createFeatureCollection_domains: S2_DOMAIN,
+            s2_createFeatureCollection_Network_Ind: NETWORK_IND,
+            s2_10m_createFeatureCollection_estimates: S2_10M_ESTIMATES,
+            s2_10m_createFeatureCollection_errors: S2_10M_ERRORS,
+            s2_10m_createFeatureCollection_domains: S2_10M_DOMAIN,
+            s2_10m_createFeatureCollection_Network_Ind: NETWORK_IND}[loader]
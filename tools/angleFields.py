@@ -0,0 +1,100 @@
+# angleFields.py
+
+# Sun and view angle fields of a Sentinel-2 tile, kept on their native 23x23 grid (5 km
+# steps) from MTD_TL.xml and evaluated only on the pixel grid actually requested.
+# A field is a dict:
+#   'values'  : 2D grid of angles (degrees), NaN cells filled
+#   'ulx','uly': map coordinates of the first grid node (the tile upper-left corner)
+#   'colstep','rowstep': grid spacing in map units (metres)
+
+import numpy
+from tools import read_sentinel2_safe_image
+
+
+def make_angle_field(values, ulx, uly, colstep, rowstep):
+    """Build an angle field from a grid whose node (i, j) lies at (ulx + j*colstep, uly - i*rowstep)."""
+    values = numpy.array(values, dtype=numpy.float64)
+    # grid cells outside the swath (or outside every detector) are NaN: fill them with the
+    # mean of the valid cells so they do not propagate into the interpolation
+    if numpy.isnan(values).any():
+        mean_angle = numpy.nanmean(values) if not numpy.isnan(values).all() else 0.0
+        values = numpy.nan_to_num(values, nan=mean_angle)
+    return {'values': values, 'ulx': ulx, 'uly': uly, 'colstep': colstep, 'rowstep': rowstep}
+
+
+def read_angle_fields(xml):
+    """Read the SZA, SAA, VZA and VAA fields of a tile from its MTD_TL.xml."""
+    (SZA, SAA, colstep, rowstep) = read_sentinel2_safe_image.parse_sun_angles(xml)
+    (VZA, VAA, vcolstep, vrowstep) = read_sentinel2_safe_image.parse_sensor_angles(xml)
+    (ulx, uly) = read_sentinel2_safe_image.parse_tile_geoposition(xml)
+    return {'SZA': make_angle_field(SZA, ulx, uly, colstep, rowstep),
+            'SAA': make_angle_field(SAA, ulx, uly, colstep, rowstep),
+            'VZA': make_angle_field(VZA, ulx, uly, vcolstep, vrowstep),
+            'VAA': make_angle_field(VAA, ulx, uly, vcolstep, vrowstep)}
+
+
+def interp_grid(values, grid_rows, grid_cols, dtype=numpy.float32):
+    """
+    Bilinearly interpolate a 2D grid at the fractional grid rows x grid cols (1D arrays),
+    clamping outside the grid. Returns a (len(grid_rows), len(grid_cols)) array.
+    """
+    grid_rows = numpy.clip(numpy.asarray(grid_rows, dtype=numpy.float64), 0, values.shape[0] - 1)
+    grid_cols = numpy.clip(numpy.asarray(grid_cols, dtype=numpy.float64), 0, values.shape[1] - 1)
+    r0 = numpy.minimum(grid_rows.astype(int), values.shape[0] - 2) if values.shape[0] > 1 else numpy.zeros(len(grid_rows), int)
+    c0 = numpy.minimum(grid_cols.astype(int), values.shape[1] - 2) if values.shape[1] > 1 else numpy.zeros(len(grid_cols), int)
+    r1 = numpy.minimum(r0 + 1, values.shape[0] - 1)
+    c1 = numpy.minimum(c0 + 1, values.shape[1] - 1)
+    wr = (grid_rows - r0)[:, None]
+    wc = (grid_cols - c0)[None, :]
+    top = values[r0][:, c0] * (1 - wc) + values[r0][:, c1] * wc
+    bottom = values[r1][:, c0] * (1 - wc) + values[r1][:, c1] * wc
+    return (top * (1 - wr) + bottom * wr).astype(dtype)
+
+
+def interp_points(values, grid_rows, grid_cols, dtype=numpy.float32):
+    """As interp_grid at the scattered points (grid_rows[i], grid_cols[i]); returns a 1D array."""
+    grid_rows = numpy.clip(numpy.asarray(grid_rows, dtype=numpy.float64), 0, values.shape[0] - 1)
+    grid_cols = numpy.clip(numpy.asarray(grid_cols, dtype=numpy.float64), 0, values.shape[1] - 1)
+    r0 = numpy.minimum(grid_rows.astype(int), max(values.shape[0] - 2, 0))
+    c0 = numpy.minimum(grid_cols.astype(int), max(values.shape[1] - 2, 0))
+    r1 = numpy.minimum(r0 + 1, values.shape[0] - 1)
+    c1 = numpy.minimum(c0 + 1, values.shape[1] - 1)
+    wr = grid_rows - r0
+    wc = grid_cols - c0
+    top = values[r0, c0] * (1 - wc) + values[r0, c1] * wc
+    bottom = values[r1, c0] * (1 - wc) + values[r1, c1] * wc
+    return (top * (1 - wr) + bottom * wr).astype(dtype)
+
+
+def evaluate_field(field, transform, shape, dtype=numpy.float32):
+    """
+    Evaluate an angle field at the pixel centres of the (north-up) grid described by an
+    affine transform and a (rows, cols) shape, e.g. a window of a BOA image at any resolution.
+    """
+    x = transform.c + (numpy.arange(shape[1]) + 0.5) * transform.a
+    y = transform.f + (numpy.arange(shape[0]) + 0.5) * transform.e
+    return interp_grid(field['values'], (field['uly'] - y) / field['rowstep'], (x - field['ulx']) / field['colstep'], dtype)
+
+
+def cosine_grids(SZA, SAA, VZA, VAA):
+    """
+    Compute cosSZA, cosVZA and cosRAA on the native (coarse) angle grid. The relative
+    azimuth is only used through its cosine, so azimuths wrapping at 0/360 are handled
+    before anything is interpolated.
+    """
+    return {'cosSZA': numpy.cos(numpy.deg2rad(SZA)),
+            'cosVZA': numpy.cos(numpy.deg2rad(VZA)),
+            'cosRAA': numpy.cos(numpy.deg2rad(numpy.absolute(SAA - VAA)))}
+
+
+def interp_window(grid, full_shape, window=None, dtype=numpy.float32):
+    """
+    Bilinearly interpolate a coarse grid covering the same extent as a raster of
+    full_shape (rows, cols) at the pixel centres of window (rasterio Window, whole
+    raster if None), e.g. a cosine grid onto one processing block.
+    """
+    row_off, col_off, rows, cols = (0, 0) + tuple(full_shape) if window is None else \
+        (int(window.row_off), int(window.col_off), int(window.height), int(window.width))
+    grid_rows = (row_off + numpy.arange(rows) + 0.5) * grid.shape[0] / full_shape[0] - 0.5
+    grid_cols = (col_off + numpy.arange(cols) + 0.5) * grid.shape[1] / full_shape[1] - 0.5
+    return interp_grid(grid, grid_rows, grid_cols, dtype)
@@ -0,0 +1,342 @@
+# batchSL2P.py
+
+# Command line driver running SL2P over directories of inputs, unattended:
+#
+#   python -m tools.batchSL2P INPUT [INPUT ...] -o OUTDIR [-v LAI fAPAR ...] [--safe SAFE_ROOT]
+#                             [--workers N] [--dtype int16] [--compress ZSTD] [--dry-run]
+#                             [--quiet] [--profile-log PROFILE.jsonl] [--cache CACHE_DIR] [--checksum]
+#
+# (run from the repository root, the networks are read from nets/)
+# Inputs are discovered recursively under every INPUT path:
+#   - FORCE tile directories: one TIF per band (*_BLU.tif, *_GRN.tif, ...) plus the sun/sensor
+#     angle TIFs, processed block-wise with streamSL2P (collection S2_FORCE)
+#   - FORCE datacube BOA files: X*_Y*/<date>_LEVEL2_<sensor>_BOA.tif (and the QAI next to it),
+#     with the angles of the SAFE product of the same date and mission found under --safe
+#     (collection S2_SINGLE_TIF, see read_single_tif_xml_angles)
+#   - Sentinel-2 L2A *.SAFE directories, 20m bands (collection S2_SR)
+# Jobs are tracked per (input, variable) pair: finished ones are appended to OUTDIR/sl2p_manifest.jsonl
+# and skipped by later runs while their product exists and is up to date, so an interrupted run
+# resumes where it stopped by running the same command again. Failed jobs are recorded and
+# retried next time. Every product carries the fingerprint of its input files, networks and
+# options (fingerprintSL2P): a product whose fingerprint changed, e.g. after a BOA file or a
+# network in nets/ was updated, is recorded as stale and recomputed, the others are kept, so
+# rerunning an archive only recomputes the delta (--checksum compares file contents instead of
+# sizes and mtimes).
+# Progress is logged to stderr (--quiet: warnings and errors only); with --profile-log the
+# per-stage timings of every job are appended to a JSON lines file (see profileSL2P).
+# With --cache the prepared inputs are kept in a cacheSL2P directory, so reruns of an input for
+# other variables or after a network update skip reading and preparation.
+
+import argparse
+import datetime
+import glob
+import json
+import logging
+import os
+import re
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import rasterio
+from tools import SL2P
+from tools import registrySL2P
+from tools import dictionariesSL2P
+from tools import streamSL2P
+from tools import write_sl2p_product
+from tools import read_sentinel2_safe_image
+from tools import profileSL2P
+from tools import cacheSL2P
+from tools import fingerprintSL2P
+from tools import toolsNets
+from tools.read_sentinel2_force_image import read_single_tif_xml_angles
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'sl2p_manifest.jsonl'
+COLLECTIONS = {'force': 'S2_FORCE', 'boa': 'S2_SINGLE_TIF', 'safe': 'S2_SR'}
+
+
+# ====================================================================
+# DISCOVERY
+# ====================================================================
+
+def _date(name):
+    """First YYYYMMDD date in a FORCE or SAFE file name."""
+    match = re.search(r'(?<!\d)(20\d{6})', name)
+    return match.group(1) if match else None
+
+
+def _mission(name):
+    """S2A/S2B/... from a FORCE (SEN2A) or SAFE (S2A_) name."""
+    match = re.search(r'SEN2([A-D])|(?:^|_)S2([A-D])_', name)
+    return 'S2' + (match.group(1) or match.group(2)) if match else None
+
+
+def find_safe(safe_root, boa_path):
+    """
+    Return the SAFE directory under safe_root with the date and mission of a datacube BOA file.
+    When several match (neighbouring S2 tiles), the one whose tile extent overlaps the BOA most
+    is used; the SAFE tile and the BOA are assumed to share the same CRS, as in read_single_tif_xml_angles.
+    """
+    name = os.path.basename(boa_path)
+    candidates = [path for path in glob.glob(os.path.join(safe_root, '**', '*.SAFE'), recursive=True)
+                  if _date(os.path.basename(path)) == _date(name)
+                  and _mission(name) in (None, _mission(os.path.basename(path)))]
+    if len(candidates) <= 1:
+        return candidates[0] if candidates else None
+    with rasterio.open(boa_path) as src:
+        bounds = src.bounds
+    def overlap(safe):
+        granule = os.path.join(safe, 'GRANULE', os.listdir(os.path.join(safe, 'GRANULE'))[0], 'MTD_TL.xml')
+        (ulx, uly) = read_sentinel2_safe_image.parse_tile_geoposition(granule)
+        width = max(0, min(bounds.right, ulx + 109800) - max(bounds.left, ulx))
+        height = max(0, min(bounds.top, uly) - max(bounds.bottom, uly - 109800))
+        return width * height
+    return max(candidates, key=overlap)
+
+
+def discover_inputs(roots, safe_root=None):
+    """
+    Return the inputs found under roots as dicts with keys 'kind' (force, boa or safe), 'path',
+    'tile', 'date', 'name' and, for boa inputs, 'safe' (angle source) and 'qai'.
+    """
+    inputs = []
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            if dirpath.endswith('.SAFE'):
+                name = os.path.basename(dirpath)
+                inputs.append({'kind': 'safe', 'path': dirpath, 'tile': name.split('_')[5] if name.count('_') >= 5 else name,
+                               'date': _date(name), 'name': name[:-len('.SAFE')]})
+                dirnames[:] = []
+                continue
+            dirnames.sort()
+            tifs = [fn for fn in sorted(filenames) if fn.endswith('.tif')]
+            if any(fn.endswith('_BLU.tif') for fn in tifs) and 'sun_zenith_degrees.tif' in tifs:
+                name = os.path.basename(os.path.normpath(dirpath))
+                inputs.append({'kind': 'force', 'path': dirpath, 'tile': name,
+                               'date': _date(next(fn for fn in tifs if fn.endswith('_BLU.tif'))), 'name': name})
+            for fn in tifs:
+                if fn.endswith('_BOA.tif'):
+                    path = os.path.join(dirpath, fn)
+                    qai = path[:-len('_BOA.tif')] + '_QAI.tif'
+                    inputs.append({'kind': 'boa', 'path': path, 'tile': os.path.basename(dirpath), 'date': _date(fn),
+                                   'name': fn[:-len('.tif')], 'qai': qai if os.path.exists(qai) else None,
+                                   'safe': find_safe(safe_root, path) if safe_root else None})
+    return inputs
+
+
+def make_jobs(inputs, variables, outDir):
+    """Expand inputs into one job per input with its variables and output prefix."""
+    jobs = []
+    for inp in inputs:
+        name = '%s_%s' % (inp['date'], inp['name']) if inp['kind'] == 'force' and inp['date'] else inp['name']
+        outPrefix = os.path.join(outDir, inp['tile'], name)
+        jobs.append(dict(inp, collection=COLLECTIONS[inp['kind']], variables=list(variables), outPrefix=outPrefix,
+                         id='%s:%s' % (inp['kind'], os.path.abspath(inp['path']))))
+    return jobs
+
+
+# ====================================================================
+# MANIFEST
+# ====================================================================
+
+def read_manifest(outDir):
+    """Return {(job id, variable): last manifest record} of outDir."""
+    records = {}
+    path = os.path.join(outDir, MANIFEST)
+    if os.path.exists(path):
+        with open(path) as fp:
+            for line in fp:
+                line = line.strip()
+                if line:
+                    record = json.loads(line)
+                    records[(record['job'], record['variable'])] = record
+    return records
+
+
+def append_manifest(outDir, records):
+    with open(os.path.join(outDir, MANIFEST), 'a') as fp:
+        for record in records:
+            fp.write(json.dumps(record) + '\n')
+
+
+def product_changes(job, manifest):
+    """
+    Return {variable: changes} for the variables of a job whose product must be computed: not
+    finished in the manifest (['missing']) or whose fingerprint (job['fingerprints']) differs
+    from the one stored in the product (see fingerprintSL2P.changes).
+    """
+    pending = {}
+    for variableName in job['variables']:
+        path = write_sl2p_product.product_path(job['outPrefix'], variableName)
+        changes = fingerprintSL2P.changes(path, job['fingerprints'][variableName])
+        if manifest.get((job['id'], variableName), {}).get('status') != 'done' and not changes:
+            changes = ['missing']
+        if changes:
+            pending[variableName] = changes
+    return pending
+
+
+def pending_variables(job, manifest):
+    """Variables of a job without a finished, up to date product."""
+    return list(product_changes(job, manifest))
+
+
+# ====================================================================
+# PROCESSING
+# ====================================================================
+
+def job_files(job):
+    """Return the input files of a job (bands, QAI, angles and metadata), as fingerprinted and cached."""
+    if job['kind'] == 'force':
+        return [os.path.join(job['path'], fn) for fn in sorted(os.listdir(job['path'])) if fn.endswith('.tif')]
+    if job['kind'] == 'boa':
+        return [job['path']] + ([job['qai']] if job['qai'] else []) + \
+            (glob.glob(os.path.join(job['safe'], 'GRANULE', '*', 'MTD_TL.xml')) if job['safe'] else [])
+    return sorted(glob.glob(os.path.join(job['path'], 'GRANULE', '*', 'IMG_DATA', 'R20m', '*.jp2')) +
+                  glob.glob(os.path.join(job['path'], 'GRANULE', '*', 'MTD_TL.xml')))
+
+
+def fingerprint_options(options):
+    """The options of a run that change the product values or layout (fingerprintSL2P 'options')."""
+    return {key: options[key] for key in ['backend', 'dtype', 'pack_flags']}
+
+
+def run_job(job, options):
+    """Process the variables of a job; returns {variable: product path}."""
+    os.makedirs(os.path.dirname(job['outPrefix']), exist_ok=True)
+    variables = job['variables']
+    writer = {'dtype': options['dtype'], 'compress': options['compress'], 'pack_flags': options['pack_flags']}
+    tags = {variableName: fingerprintSL2P.fingerprint_tags(job['fingerprints'][variableName]) for variableName in variables} \
+        if 'fingerprints' in job else {}
+    if job['kind'] == 'force':
+        return streamSL2P.run_sl2p_stream(job['path'], job['collection'], job['outPrefix'], variables,
+                                          options['chunk_size'], None, options['backend'], **writer,
+                                          cache_dir=options.get('cache_dir'), tags=tags)
+    bands = registrySL2P.get_net_options(variables[0], job['collection'])['inputBands']
+    if job['kind'] == 'boa':
+        if job['safe'] is None:
+            raise FileNotFoundError('No SAFE product with the angles of %s (use --safe)' % job['path'])
+        read = lambda: read_single_tif_xml_angles(job['path'], job['safe'], bands=bands, qai_path=job['qai'])
+    else:
+        read = lambda: read_sentinel2_safe_image.read_s2(job['path'], 20)
+    sl2p_inp, mask, inputFlag, profile = cacheSL2P.prepared_input(options.get('cache_dir'), job_files(job), read, variables[0], job['collection'])
+    varmap = SL2P.SL2P_multi(sl2p_inp, job['collection'], variables, mask=mask, backend=options['backend'], inputFlag=inputFlag)
+    return {variableName: write_sl2p_product.write_product(write_sl2p_product.product_path(job['outPrefix'], variableName),
+                                                           profile, variableName, varmap, **writer, tags=tags.get(variableName))
+            for variableName in variables}
+
+
+def _run_job(job, options):
+    """
+    run_job for a worker: returns (job, products, error) instead of raising. The run is
+    profiled and its record appended to options['profile_log'] (if set).
+    """
+    profileSL2P.start_run(job=job['id'], collection=job['collection'], variables=job['variables'],
+                          backend=options['backend'])
+    try:
+        return job, run_job(job, options), None
+    except Exception:
+        return job, {}, traceback.format_exc()
+    finally:
+        record = profileSL2P.end_run(options.get('profile_log'))
+        logger.info('%s: %.1f s, %s peak memory %s MB', job['path'], record['seconds'], record['peak_memory_scope'], record['peak_memory_mb'])
+
+
+def _records(job, products, error):
+    now = datetime.datetime.now().isoformat(timespec='seconds')
+    if error is not None:
+        return [{'job': job['id'], 'variable': variableName, 'status': 'failed', 'error': error, 'time': now}
+                for variableName in job['variables']]
+    return [{'job': job['id'], 'variable': variableName, 'status': 'done', 'product': products[variableName],
+             'collection': job['collection'], 'tile': job['tile'], 'date': job['date'], 'time': now,
+             'fingerprint': job.get('fingerprints', {}).get(variableName)}
+            for variableName in job['variables']]
+
+
+def run_batch(roots, outDir, variables=None, safe_root=None, workers=1, backend='float64', dtype='float32',
+              compress='DEFLATE', pack_flags=True, chunk_size=streamSL2P.CHUNK_SIZE, dry_run=False,
+              profile_log=None, cache_dir=None, checksum=False):
+    """
+    Discover the inputs under roots and run every job whose products are not finished in the
+    manifest of outDir or out of date (fingerprintSL2P, checksum: compare the contents of the
+    input files), in this process or, with workers > 1, in a pool of worker processes that keep
+    their networks loaded across jobs. profile_log: JSON lines file receiving the profile record
+    of every job (profileSL2P.PROFILE_LOG if None). cache_dir: cacheSL2P directory of the prepared
+    inputs (cacheSL2P.CACHE_DIR if None, no cache if both are None). Returns the list of manifest
+    records written.
+    """
+    if variables is None:
+        variables = list(dictionariesSL2P.make_outputParams().keys())
+    os.makedirs(outDir, exist_ok=True)
+    manifest = read_manifest(outDir)
+    options = {'backend': backend, 'dtype': dtype, 'compress': compress, 'pack_flags': pack_flags, 'chunk_size': chunk_size,
+               'profile_log': profile_log, 'cache_dir': cache_dir or cacheSL2P.CACHE_DIR}
+    jobs = []
+    stale = []
+    now = datetime.datetime.now().isoformat(timespec='seconds')
+    for job in make_jobs(discover_inputs(roots, safe_root), variables, outDir):
+        paths = job_files(job)
+        job['fingerprints'] = {variableName: fingerprintSL2P.product_fingerprint(paths, job['collection'], variableName,
+                                                                                 fingerprint_options(options), checksum)
+                               for variableName in variables}
+        changes = product_changes(job, manifest)
+        job['variables'] = list(changes)
+        # existing products computed from other inputs, networks or options are invalidated
+        stale.extend({'job': job['id'], 'variable': variableName, 'status': 'stale', 'changed': changed, 'time': now}
+                     for variableName, changed in changes.items() if changed != ['missing'])
+        if job['variables']:
+            jobs.append(dict(job, changes=changes))
+    logger.info('%d jobs to run in %s (%d stale products)', len(jobs), outDir, len(stale))
+    if dry_run:
+        for job in jobs:
+            print('%s %s %s -> %s' % (job['collection'], job['path'], ','.join('%s(%s)' % (variableName, ','.join(changed))
+                  for variableName, changed in job['changes'].items()), job['outPrefix']))
+        return []
+    if stale:
+        append_manifest(outDir, stale)
+    written = []
+    def done(job, products, error):
+        records = _records(job, products, error)
+        append_manifest(outDir, records)
+        written.extend(records)
+        if error:
+            logger.error('FAILED %s\n%s', job['path'], error)
+        else:
+            logger.info('Done %s', job['path'])
+    if not workers or workers <= 1:
+        for job in jobs:
+            done(*_run_job(job, options))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for future in as_completed([pool.submit(_run_job, job, options) for job in jobs]):
+                done(*future.result())
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m tools.batchSL2P', description='Run SL2P over directories of FORCE tiles, FORCE datacube BOA files or SAFE products.')
+    parser.add_argument('inputs', nargs='+', help='directories searched recursively for inputs')
+    parser.add_argument('-o', '--out', required=True, help='output directory (products and %s)' % MANIFEST)
+    parser.add_argument('-v', '--variables', nargs='+', choices=list(dictionariesSL2P.make_outputParams().keys()),
+                        help='variables to produce (default: all)')
+    parser.add_argument('--safe', help='directory searched for the SAFE products holding the angles of datacube BOA files')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes (default 1)')
+    parser.add_argument('--backend', default='float64', choices=toolsNets.BACKENDS, help='inference backend')
+    parser.add_argument('--dtype', default='float32', choices=sorted(write_sl2p_product.PRODUCT_NODATA), help='product data type')
+    parser.add_argument('--compress', default='DEFLATE', help='GeoTIFF compression (DEFLATE, ZSTD, LZW...)')
+    parser.add_argument('--unpacked-flags', action='store_true', help='write the input and output flags as two layers')
+    parser.add_argument('--chunk-size', type=int, default=streamSL2P.CHUNK_SIZE, help='block size of FORCE tile processing')
+    parser.add_argument('--dry-run', action='store_true', help='list the jobs to run and exit')
+    parser.add_argument('-q', '--quiet', action='store_true', help='log warnings and errors only')
+    parser.add_argument('--profile-log', help='JSON lines file receiving the per-stage profile of every job (default: $SL2P_PROFILE_LOG)')
+    parser.add_argument('--cache', help='directory caching the prepared inputs across runs (default: $SL2P_CACHE_DIR, size bounded by $SL2P_CACHE_SIZE_GB)')
+    parser.add_argument('--checksum', action='store_true', help='fingerprint the input files by content instead of size and mtime')
+    args = parser.parse_args(argv)
+    profileSL2P.configure_logging(args.quiet)
+    records = run_batch(args.inputs, args.out, args.variables, args.safe, args.workers, args.backend, args.dtype,
+                        args.compress, not args.unpacked_flags, args.chunk_size, args.dry_run, args.profile_log, args.cache, args.checksum)
+    return 1 if any(record['status'] == 'failed' for record in records) else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
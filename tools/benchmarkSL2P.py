@@ -0,0 +1,283 @@
+# benchmarkSL2P.py
+
+# Benchmarks of the SL2P pipeline on synthetic FORCE tiles, so optimizations can be measured
+# without real imagery:
+#
+#   python -m tools.benchmarkSL2P [--sizes 1024 2048] [-c S2_FORCE S2_SR] [-v LAI fAPAR]
+#                                 [--repeat 3] [--save BASELINE.json] [--compare BASELINE.json]
+#
+# (run from the repository root, the networks are read from nets/)
+# A synthetic tile of size x size 20m pixels (1024 to 10980, a full S2 tile) holds the ten
+# FORCE BOA bands (*_BLU.tif ... *_SW2.tif, int16 reflectance * 10000) mixing vegetation, soil
+# and water spectra, coarse sun/sensor angle rasters, a QAI layer with cloud and water bits and
+# a nodata swath edge. Tiles are generated block by block once and reused from --workdir.
+#
+# For every size and collection the stages timed are read_s2_force (the inputBands of the
+# collection), SL2P.prepare_sl2p_inp and SL2P.invalidInput, and for every variable
+# toolsNets.applyNet and applyEnsemble (estimate net) and the full SL2P.SL2P call (with the
+# valid pixel mask).
+# Each stage reports the best time of --repeat calls, its throughput in Mpix/s of the tile,
+# and the peak memory it allocated (tracemalloc, measured on an extra first call; GDAL's own
+# cache is not included).
+#
+# --save writes the results as a JSON baseline; --compare checks them against a baseline and
+# flags throughput drops and memory growth beyond --tolerance/--memory-tolerance (exit code 1).
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+import numpy
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from tools import SL2P
+from tools import toolsNets
+from tools import registrySL2P
+from tools import dictionariesSL2P
+from tools import profileSL2P
+from tools.read_sentinel2_force_image import read_s2_force
+
+SIZES = [1024, 2048, 4096, 10980]
+COLLECTIONS = ['S2_FORCE', 'S2_SR', 'S2_SR_10m', 'S2_SINGLE_TIF']
+STAGES = ['read', 'prepare', 'invalidInput', 'applyNet', 'applyEnsemble', 'SL2P']
+
+# FORCE file names of the bands (see read_sentinel2_force_image.map_force_band_name)
+FORCE_NAMES = {'B02': 'BLU', 'B03': 'GRN', 'B04': 'RED', 'B05': 'RE1', 'B06': 'RE2', 'B07': 'RE3',
+               'B08': 'BNR', 'B8A': 'NIR', 'B11': 'SW1', 'B12': 'SW2'}
+# surface reflectance of the end members, in the order of FORCE_NAMES
+SPECTRA = {
+    'vegetation': [0.03, 0.06, 0.03, 0.10, 0.30, 0.40, 0.45, 0.46, 0.22, 0.10],
+    'soil':       [0.08, 0.11, 0.14, 0.17, 0.20, 0.22, 0.24, 0.25, 0.32, 0.28],
+    'water':      [0.06, 0.05, 0.03, 0.02, 0.015, 0.01, 0.01, 0.01, 0.005, 0.003],
+    'cloud':      [0.45, 0.45, 0.46, 0.47, 0.48, 0.48, 0.49, 0.49, 0.40, 0.30],
+}
+# QAI bits of the synthetic tile (FORCE: 0 nodata, 1 cloud, 5 water)
+QAI_BITS = {'nodata': 1, 'cloud': 2, 'water': 32}
+PIXEL_SIZE = 20
+ANGLE_STEP = 250 # tile pixels per cell of the angle rasters (5 km)
+BLOCK_ROWS = 512
+TOLERANCE = 0.15
+MEMORY_TOLERANCE = 0.15
+
+
+# ====================================================================
+# SYNTHETIC TILES
+# ====================================================================
+
+def synthetic_block(size, row_off, rows, seed=0):
+    """Return the bands ({band: int16 rows x size}) and QAI of rows row_off.. of a synthetic tile."""
+    rng = numpy.random.default_rng([seed, row_off])
+    r, c = numpy.mgrid[row_off:row_off + rows, 0:size].astype(numpy.float32)
+    # smooth vegetation fraction over soil, water bodies and clouds as bands of smooth fields
+    vegetation = numpy.clip(0.5 + 0.4 * numpy.sin(c / 110.) * numpy.cos(r / 140.) + 0.1 * rng.standard_normal(r.shape), 0, 1)
+    water = numpy.sin((r + c) / 240.) * numpy.cos((r - c) / 330.) > 0.85
+    cloud = numpy.sin(r / 70.) * numpy.sin(c / 90.) * numpy.cos((r + 2 * c) / 600.) > 0.7
+    nodata = c + 0.1 * r > 0.95 * size # swath edge
+    spectra = {name: numpy.array(values, dtype=numpy.float32)[:, None, None] for name, values in SPECTRA.items()}
+    reflectance = vegetation * spectra['vegetation'] + (1 - vegetation) * spectra['soil']
+    reflectance = numpy.where(water, spectra['water'], reflectance)
+    reflectance = numpy.where(cloud, spectra['cloud'], reflectance)
+    reflectance *= 1 + 0.03 * rng.standard_normal(reflectance.shape, dtype=numpy.float32)
+    values = numpy.rint(numpy.clip(reflectance, 0, 1) * 10000).astype(numpy.int16)
+    values[:, nodata] = dictionariesSL2P.make_mask_options()['inputNodata']
+    qai = (nodata * QAI_BITS['nodata'] | cloud * QAI_BITS['cloud'] | water * QAI_BITS['water']).astype(numpy.int16)
+    return dict(zip(FORCE_NAMES, values)), qai
+
+
+def synthetic_angles(size):
+    """Return the coarse sun/sensor angle rasters ({file name: float32 grid}) of a synthetic tile."""
+    cells = max(2, -(-size // ANGLE_STEP))
+    r, c = numpy.mgrid[0:cells, 0:cells].astype(numpy.float32) / (cells - 1)
+    return {'sun_zenith_degrees.tif': 35 + 5 * r, 'sun_azimuth_degrees.tif': 155 + 4 * c,
+            'sensor_zenith_degrees.tif': 1 + 10 * numpy.abs(c - 0.5), 'sensor_azimuth_degrees.tif': 100 + 10 * r + 180 * (c > 0.5)}
+
+
+def make_synthetic_tile(tile_dir, size, seed=0):
+    """
+    Write a synthetic FORCE tile of size x size pixels to tile_dir (unless already there) and
+    return tile_dir. The tile is written BLOCK_ROWS rows at a time, so a 10980 x 10980 tile
+    needs a few hundred MB of memory (and 2.6 GB of disk).
+    """
+    done = os.path.join(tile_dir, 'synthetic.json')
+    if os.path.exists(done):
+        return tile_dir
+    os.makedirs(tile_dir, exist_ok=True)
+    profile = {'driver': 'GTiff', 'width': size, 'height': size, 'count': 1, 'dtype': 'int16', 'crs': 'EPSG:32633',
+               'transform': from_origin(400000, 5600000, PIXEL_SIZE, PIXEL_SIZE), 'tiled': True,
+               'blockxsize': 256, 'blockysize': 256, 'compress': 'DEFLATE'}
+    names = list(FORCE_NAMES.values()) + ['QAI']
+    datasets = {name: rasterio.open(os.path.join(tile_dir, '20200101_LEVEL2_SEN2A_%s.tif' % name), 'w',
+                                    **dict(profile, nodata=1 if name == 'QAI' else -9999)) for name in names}
+    try:
+        for row_off in range(0, size, BLOCK_ROWS):
+            rows = min(BLOCK_ROWS, size - row_off)
+            bands, qai = synthetic_block(size, row_off, rows, seed)
+            window = Window(0, row_off, size, rows)
+            for band, values in bands.items():
+                datasets[FORCE_NAMES[band]].write(values, 1, window=window)
+            datasets['QAI'].write(qai, 1, window=window)
+    finally:
+        for dst in datasets.values():
+            dst.close()
+    for fname, grid in synthetic_angles(size).items():
+        cell = PIXEL_SIZE * size / grid.shape[0]
+        with rasterio.open(os.path.join(tile_dir, fname), 'w', **dict(profile, dtype='float32', width=grid.shape[1],
+                           height=grid.shape[0], transform=from_origin(400000, 5600000, cell, cell), nodata=None,
+                           tiled=False)) as dst:
+            dst.write(grid.astype(numpy.float32), 1)
+    with open(done, 'w') as fp:
+        json.dump({'size': size, 'seed': seed}, fp)
+    return tile_dir
+
+
+# ====================================================================
+# MEASUREMENTS
+# ====================================================================
+
+def measure(func, repeat=3, memory=True):
+    """
+    Call func repeat times and return (best seconds, peak MB allocated during one call or None,
+    result of the last call). The memory is traced on an extra, untimed first call.
+    """
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            start, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            func()
+            peak = (tracemalloc.get_traced_memory()[1] - start) / 2. ** 20
+        finally:
+            tracemalloc.stop()
+    best = None
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, peak, result
+
+
+def result_key(result):
+    return (result['stage'], result['collection'], result['variable'], result['size'])
+
+
+def benchmark_tile(tile_dir, size, collections=COLLECTIONS, variables=None, repeat=3, backend='float64', memory=True):
+    """Benchmark the STAGES on a synthetic tile; returns the list of result records."""
+    if variables is None:
+        variables = list(dictionariesSL2P.make_outputParams().keys())
+    results = []
+    def record(stage, collection, variableName, func):
+        seconds, peak, value = measure(func, repeat, memory)
+        results.append({'stage': stage, 'collection': collection, 'variable': variableName, 'size': size,
+                        'pixels': size * size, 'seconds': seconds, 'mpix_per_s': size * size / 1e6 / seconds,
+                        'peak_mb': peak})
+        print('%-13s %-14s %-7s %6d  %9.3f s  %8.2f Mpix/s  %s MB' % (stage, collection, variableName or '-', size,
+              seconds, results[-1]['mpix_per_s'], '%.0f' % peak if peak is not None else '-'))
+        return value
+    for collection in collections:
+        # load the networks and domain first so that no stage includes their loading
+        for variableName in variables:
+            registrySL2P.get_nets(collection, variableName)
+        registrySL2P.get_domain(collection)
+        netOptions = registrySL2P.get_net_options(variables[0], collection)
+        colOptions = {'name': collection, 'sl2pDomain': registrySL2P.get_domain(collection)}
+        s2 = record('read', collection, None, lambda: read_s2_force(tile_dir, bands=netOptions['inputBands']))
+        # prepare_sl2p_inp adds the cosines to s2: every call starts from the s2 that was read
+        sl2p_inp = record('prepare', collection, None, lambda: SL2P.prepare_sl2p_inp(dict(s2), variables[0], collection))
+        s2 = dict(s2)
+        SL2P.prepare_sl2p_inp(s2, variables[0], collection)
+        mask = SL2P.make_valid_mask(s2, variables[0], collection)
+        record('invalidInput', collection, None, lambda: SL2P.invalidInput(sl2p_inp, netOptions, colOptions))
+        for variableName in variables:
+            nets = registrySL2P.get_nets(collection, variableName)
+            record('applyNet', collection, variableName, lambda: toolsNets.applyNet(sl2p_inp, nets[0], backend))
+            record('applyEnsemble', collection, variableName, lambda: toolsNets.applyEnsemble(sl2p_inp, nets[0], backend))
+            record('SL2P', collection, variableName,
+                   lambda: SL2P.SL2P(sl2p_inp, variableName, collection, mask=mask, backend=backend))
+        del s2, sl2p_inp, mask
+    return results
+
+
+def run_benchmarks(sizes=SIZES[:1], collections=COLLECTIONS, variables=None, repeat=3, backend='float64',
+                   workdir=None, seed=0, memory=True):
+    """Generate (or reuse) the synthetic tiles of sizes in workdir and benchmark them; returns a baseline dict."""
+    workdir = workdir or os.path.join(tempfile.gettempdir(), 'sl2p_benchmark')
+    results = []
+    for size in sizes:
+        tile_dir = make_synthetic_tile(os.path.join(workdir, 'synthetic_%d_%d' % (size, seed)), size, seed)
+        results.extend(benchmark_tile(tile_dir, size, collections, variables, repeat, backend, memory))
+    meta = {'date': datetime.datetime.now().isoformat(timespec='seconds'), 'host': platform.node(),
+            'machine': platform.machine(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': numpy.__version__, 'rasterio': rasterio.__version__,
+            'backend': backend, 'repeat': repeat, 'seed': seed, 'peak_memory_mb': profileSL2P.peak_memory_mb()}
+    return {'meta': meta, 'results': results}
+
+
+def compare(results, baseline, tolerance=TOLERANCE, memory_tolerance=MEMORY_TOLERANCE):
+    """
+    Compare results against the results of a baseline. A stage regresses when its throughput is
+    below (1 - tolerance) x the baseline or its peak memory above (1 + memory_tolerance) x the
+    baseline (and by more than 1 MB). Returns one row per stage in both, with 'speedup',
+    'memory_ratio' and 'regression' (list of 'throughput'/'memory').
+    """
+    base = {result_key(result): result for result in baseline['results']}
+    rows = []
+    for result in results:
+        old = base.get(result_key(result))
+        if old is None:
+            continue
+        row = dict(result, speedup=result['mpix_per_s'] / old['mpix_per_s'], memory_ratio=None, regression=[])
+        if row['speedup'] < 1 - tolerance:
+            row['regression'].append('throughput')
+        if result['peak_mb'] is not None and old['peak_mb']:
+            row['memory_ratio'] = result['peak_mb'] / old['peak_mb']
+            if row['memory_ratio'] > 1 + memory_tolerance and result['peak_mb'] - old['peak_mb'] > 1:
+                row['regression'].append('memory')
+        rows.append(row)
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m tools.benchmarkSL2P', description='Benchmark the SL2P pipeline on synthetic FORCE tiles.')
+    parser.add_argument('--sizes', nargs='+', type=int, default=SIZES[:1], help='tile edges in pixels (default %d, full tile %d)' % (SIZES[0], SIZES[-1]))
+    parser.add_argument('-c', '--collections', nargs='+', default=COLLECTIONS, choices=COLLECTIONS, help='collections (default: all)')
+    parser.add_argument('-v', '--variables', nargs='+', choices=list(dictionariesSL2P.make_outputParams().keys()),
+                        help='variables (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed calls per stage, the best is kept (default 3)')
+    parser.add_argument('--backend', default='float64', choices=toolsNets.BACKENDS, help='inference backend')
+    parser.add_argument('--workdir', help='directory of the synthetic tiles (default: a sl2p_benchmark temporary directory)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic tiles')
+    parser.add_argument('--no-memory', action='store_true', help='skip the traced call measuring the peak memory')
+    parser.add_argument('--save', help='write the results as a JSON baseline')
+    parser.add_argument('--compare', help='JSON baseline to compare the results against')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='allowed relative throughput drop (default %.2f)' % TOLERANCE)
+    parser.add_argument('--memory-tolerance', type=float, default=MEMORY_TOLERANCE, help='allowed relative peak memory growth (default %.2f)' % MEMORY_TOLERANCE)
+    args = parser.parse_args(argv)
+    profileSL2P.configure_logging(quiet=True)
+    run = run_benchmarks(args.sizes, args.collections, args.variables, args.repeat, args.backend, args.workdir,
+                         args.seed, not args.no_memory)
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump(run, fp, indent=1)
+        print('Saved %s' % args.save)
+    if args.compare:
+        with open(args.compare) as fp:
+            rows = compare(run['results'], json.load(fp), args.tolerance, args.memory_tolerance)
+        for row in rows:
+            print('%-13s %-14s %-7s %6d  speedup %5.2f  memory %s  %s' % (row['stage'], row['collection'], row['variable'] or '-',
+                  row['size'], row['speedup'], '%5.2f' % row['memory_ratio'] if row['memory_ratio'] is not None else '    -',
+                  'REGRESSION (%s)' % ', '.join(row['regression']) if row['regression'] else 'ok'))
+        regressions = [row for row in rows if row['regression']]
+        print('%d of %d stages regressed' % (len(regressions), len(rows)))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
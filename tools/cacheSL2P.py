@@ -0,0 +1,187 @@
+# cacheSL2P.py
+
+# Optional on-disk cache of prepared SL2P inputs, so reruns of an input (another variable of
+# the same collection, updated networks) skip reading, resampling and prepare_sl2p_inp.
+#
+# An entry holds, as .npy files opened memory-mapped (no copy, pages read on demand):
+#   sl2p_inp.npy    prepared (bands, rows, cols) float32 stack (prepare_sl2p_inp writes into it)
+#   mask.npy        valid pixel mask (make_valid_mask)
+#   inputFlag.npy   input flag (invalidInput) of every pixel, recomputed from the stack when the
+#                   calibration domain of the collection changes
+#   meta.json       key information and the rasterio profile
+# Entries are keyed by the paths, modification times and sizes of the input files, the
+# collection, the input bands and scaling of its networks and any extra key (window,
+# resolution); the networks themselves are not part of the key.
+# The cache is bounded to max_bytes (SL2P_CACHE_SIZE_GB, default 20 GB): the least recently
+# used entries are evicted after every store. Entries are written to a temporary (dot-prefixed,
+# never evicted) directory and renamed, so several processes may share a cache directory.
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import numpy
+from affine import Affine
+from rasterio.crs import CRS
+from tools import SL2P
+from tools import registrySL2P
+from tools import profileSL2P
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.environ.get('SL2P_CACHE_DIR')
+CACHE_SIZE = int(float(os.environ.get('SL2P_CACHE_SIZE_GB', 20)) * 2 ** 30)
+CACHE_VERSION = 1
+ARRAYS = ['sl2p_inp', 'mask', 'inputFlag']
+
+
+def cache_key(paths, imageCollectionName, variableName, **extra):
+    """Return the key of the prepared input of files paths for the networks of variableName in imageCollectionName."""
+    netOptions = registrySL2P.get_net_options(variableName, imageCollectionName)
+    files = []
+    for path in sorted(os.path.abspath(path) for path in paths):
+        stat = os.stat(path)
+        files.append([path, stat.st_mtime_ns, stat.st_size])
+    content = {'version': CACHE_VERSION, 'files': files, 'collection': imageCollectionName,
+               'inputBands': netOptions['inputBands'], 'inputScaling': netOptions['inputScaling'],
+               'inputOffset': netOptions['inputOffset'], 'extra': extra}
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def domain_hash(imageCollectionName):
+    return hashlib.sha1(numpy.ascontiguousarray(registrySL2P.get_domain(imageCollectionName)).tobytes()).hexdigest()
+
+
+def dump_profile(profile):
+    """Return a JSON-able copy of a rasterio profile."""
+    profile = dict(profile)
+    if profile.get('crs') is not None:
+        profile['crs'] = profile['crs'].to_wkt()
+    profile['transform'] = list(profile['transform'])[:6]
+    return profile
+
+
+def load_profile(profile):
+    profile = dict(profile)
+    if profile.get('crs') is not None:
+        profile['crs'] = CRS.from_wkt(profile['crs'])
+    profile['transform'] = Affine(*profile['transform'])
+    return profile
+
+
+def load(cache_dir, key, imageCollectionName, variableName):
+    """
+    Return the entry of key ({'sl2p_inp', 'mask', 'inputFlag': read-only memmaps, 'profile'})
+    or None, and mark it as recently used.
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    try:
+        with open(os.path.join(entry_dir, 'meta.json')) as fp:
+            meta = json.load(fp)
+        entry = {name: numpy.load(os.path.join(entry_dir, name + '.npy'), mmap_mode='r') for name in ARRAYS}
+    except (OSError, ValueError):
+        return None
+    os.utime(os.path.join(entry_dir, 'meta.json'))
+    if meta['domain'] != domain_hash(imageCollectionName):
+        # updated calibration domain: only the input flag is stale
+        logger.info('Recomputing the cached input flag of %s (new calibration domain)', key)
+        inputFlag = SL2P.invalidInput(entry['sl2p_inp'], registrySL2P.get_net_options(variableName, imageCollectionName),
+                                      {'name': imageCollectionName, 'sl2pDomain': registrySL2P.get_domain(imageCollectionName)})
+        _save_array(entry_dir, 'inputFlag', inputFlag)
+        _write_meta(entry_dir, dict(meta, domain=domain_hash(imageCollectionName)))
+        entry['inputFlag'] = numpy.load(os.path.join(entry_dir, 'inputFlag.npy'), mmap_mode='r')
+    entry['profile'] = load_profile(meta['profile'])
+    return entry
+
+
+def _save_array(entry_dir, name, array):
+    tmp = os.path.join(entry_dir, name + '.tmp.npy')
+    numpy.save(tmp, array)
+    os.replace(tmp, os.path.join(entry_dir, name + '.npy'))
+
+
+def _write_meta(entry_dir, meta):
+    tmp = os.path.join(entry_dir, 'meta.tmp.json')
+    with open(tmp, 'w') as fp:
+        json.dump(meta, fp)
+    os.replace(tmp, os.path.join(entry_dir, 'meta.json'))
+
+
+def entry_bytes(entry_dir):
+    return sum(entry.stat().st_size for entry in os.scandir(entry_dir) if entry.is_file())
+
+
+def evict(cache_dir, max_bytes=CACHE_SIZE, keep=None):
+    """Delete the least recently used entries of cache_dir until it holds at most max_bytes (never keep); returns the keys deleted."""
+    entries = []
+    for entry in os.scandir(cache_dir):
+        meta = os.path.join(entry.path, 'meta.json')
+        # dot-prefixed directories are entries being written by prepared_input
+        if entry.is_dir() and not entry.name.startswith('.') and os.path.exists(meta):
+            entries.append((os.stat(meta).st_mtime, entry.name, entry_bytes(entry.path)))
+    total = sum(size for _, _, size in entries)
+    deleted = []
+    for _, key, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if key == keep:
+            continue
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        total -= size
+        deleted.append(key)
+    if deleted:
+        logger.info('Evicted %d cache entries from %s', len(deleted), cache_dir)
+    return deleted
+
+
+def prepared_input(cache_dir, paths, read, variableName, imageCollectionName, max_bytes=CACHE_SIZE, **extra):
+    """
+    Return (sl2p_inp, mask, inputFlag, profile) of the input made of files paths, where read()
+    returns its s2 dict (e.g. a reader call). With cache_dir, a cached entry is returned
+    memory-mapped without calling read, and a new entry is prepared straight into its files
+    and stored; extra (e.g. window) is added to the key. Without cache_dir the input is read
+    and prepared as usual and inputFlag is None (SL2P computes it).
+    """
+    if cache_dir is None:
+        s2 = read()
+        sl2p_inp = SL2P.prepare_sl2p_inp(s2, variableName, imageCollectionName)
+        return sl2p_inp, SL2P.make_valid_mask(s2, variableName, imageCollectionName), None, s2['profile']
+    key = cache_key(paths, imageCollectionName, variableName, **extra)
+    with profileSL2P.stage('cache'):
+        entry = load(cache_dir, key, imageCollectionName, variableName)
+    if entry is not None:
+        logger.debug('Prepared input %s read from the cache', key)
+        return entry['sl2p_inp'], entry['mask'], entry['inputFlag'], entry['profile']
+
+    s2 = read()
+    netOptions = registrySL2P.get_net_options(variableName, imageCollectionName)
+    shape = (len(netOptions['inputBands']),) + s2[[band for band in netOptions['inputBands'] if band.startswith('B')][0]].shape
+    os.makedirs(cache_dir, exist_ok=True)
+    entry_dir = tempfile.mkdtemp(prefix='.' + key, dir=cache_dir)
+    try:
+        # the stack is prepared in place in the memory-mapped file of the entry
+        sl2p_inp = numpy.lib.format.open_memmap(os.path.join(entry_dir, 'sl2p_inp.npy'), mode='w+', dtype=numpy.float32, shape=shape)
+        SL2P.prepare_sl2p_inp(s2, variableName, imageCollectionName, out=sl2p_inp)
+        mask = SL2P.make_valid_mask(s2, variableName, imageCollectionName)
+        with profileSL2P.stage('invalidInput', mask.size):
+            inputFlag = SL2P.invalidInput(sl2p_inp, netOptions, {'name': imageCollectionName, 'sl2pDomain': registrySL2P.get_domain(imageCollectionName)})
+        with profileSL2P.stage('cache'):
+            sl2p_inp.flush()
+            numpy.save(os.path.join(entry_dir, 'mask.npy'), mask)
+            numpy.save(os.path.join(entry_dir, 'inputFlag.npy'), inputFlag)
+            _write_meta(entry_dir, {'key': key, 'paths': sorted(paths), 'collection': imageCollectionName, 'extra': extra,
+                                    'domain': domain_hash(imageCollectionName), 'created': time.time(),
+                                    'profile': dump_profile(s2['profile'])})
+            try:
+                os.rename(entry_dir, os.path.join(cache_dir, key))
+                entry_dir = None
+            except OSError:
+                pass # stored meanwhile by another process
+    finally:
+        if entry_dir is not None:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+    evict(cache_dir, max_bytes, keep=key)
+    return sl2p_inp, mask, inputFlag, s2['profile']
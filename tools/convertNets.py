@@ -0,0 +1,105 @@
+# convertNets.py
+
+# One-time converter from the Matlab-exported nets/*.pkl FeatureCollections to a single
+# versioned .npz file, and the loader used by registrySL2P to open it.
+#
+# Layout of the .npz (all arrays, no pickled objects):
+#   format_version                                   int, NETS_FORMAT_VERSION
+#   sources                                          str array, 'path:sha1' of the converted pickles
+#                                                    (registrySL2P falls back to the pickles when
+#                                                    any of them changed, see changed_sources)
+#   <collection>/sl2pDomain                          sorted DomainCode values
+#   <collection>/<variable>/<estimate|error>/<coef>  coefficients stacked over the numNets members
+#                                                    (h1wt is stored as members x hidden x inputs)
+#
+# Usage: python -m tools.convertNets [nets/sl2p_nets.npz]
+
+import glob
+import hashlib
+import os
+import sys
+import numpy
+from tools import toolsNets
+from tools import dictionariesSL2P
+from tools import SL2PV0 as algorithm
+
+NETS_FORMAT_VERSION = 1
+NETS_FILE = 'nets/sl2p_nets.npz'
+NET_COEFS = ['inpSlope', 'inpOffset', 'h1wt', 'h1bi', 'h2wt', 'h2bi', 'outSlope', 'outBias']
+NET_KINDS = {'estimate': "Collection_SL2P", 'error': "Collection_SL2Perrors"}
+
+
+def convert_nets(outPath=NETS_FILE):
+    """Convert the nets/*.pkl assets of every collection and variable into outPath."""
+    arrays = {'format_version': numpy.array(NETS_FORMAT_VERSION)}
+    networkOptions = dictionariesSL2P.make_net_options()
+    collectionOptions = dictionariesSL2P.make_collection_options(algorithm)
+    for imageCollectionName, colOptions in collectionOptions.items():
+        numNets = len({k: v for k, v in (colOptions["Network_Ind"]['features'][0]['properties']).items() if k != 'Feature Index'})
+        arrays['%s/sl2pDomain' % imageCollectionName] = numpy.sort(numpy.array(
+            [row['properties']['DomainCode'] for row in colOptions["sl2pDomain"]['features']]))
+        for variableName in networkOptions:
+            variable = networkOptions[variableName][imageCollectionName]['variable']
+            for kind, asset in NET_KINDS.items():
+                nets = toolsNets.makeNetVars(colOptions[asset], numNets, variable-1)
+                for coef in NET_COEFS:
+                    values = numpy.array([net[0][coef] for net in nets], dtype=numpy.float64)
+                    if coef == 'h1wt':
+                        hidden = len(nets[0][0]['h1bi'])
+                        values = values.reshape(numNets, hidden, -1)
+                    arrays['%s/%s/%s/%s' % (imageCollectionName, variableName, kind, coef)] = values
+    arrays['sources'] = numpy.array(['%s:%s' % (path, _sha1(path)) for path in sorted(glob.glob('nets/*.pkl'))])
+    numpy.savez(outPath, **arrays)
+    return outPath
+
+
+def load_nets(path=NETS_FILE):
+    """
+    Open a file written by convert_nets. Returns a dict keyed by (collection, variable)
+    holding the (estimate, error) networks in the makeNetVars layout (numNets x [net]),
+    with numpy arrays as coefficients, and a dict of the domain codes per collection.
+    """
+    with numpy.load(path, allow_pickle=False) as data:
+        version = int(data['format_version'])
+        if version != NETS_FORMAT_VERSION:
+            raise ValueError('%s has nets format version %s, expected %s (rerun python -m tools.convertNets)'
+                             % (path, version, NETS_FORMAT_VERSION))
+        arrays = {key: data[key] for key in data.files}
+    nets = {}
+    domains = {}
+    for key in arrays:
+        parts = key.split('/')
+        if len(parts) == 2:
+            domains[parts[0]] = arrays[key]
+        elif len(parts) == 4 and parts[2] == 'estimate' and parts[3] == 'h1bi':
+            imageCollectionName, variableName = parts[0], parts[1]
+            nets[(imageCollectionName, variableName)] = tuple(
+                [[{coef: arrays['%s/%s/%s/%s' % (imageCollectionName, variableName, kind, coef)][member] for coef in NET_COEFS}]
+                 for member in range(arrays[key].shape[0])]
+                for kind in NET_KINDS)
+    return nets, domains
+
+
+def changed_sources(path=NETS_FILE):
+    """
+    Return the pickles converted into path whose content changed since (sha1 of the
+    'sources' entries); pickles that no longer exist are not reported, the file then
+    stands on its own.
+    """
+    with numpy.load(path, allow_pickle=False) as data:
+        sources = [str(source) for source in data['sources']] if 'sources' in data.files else []
+    changed = []
+    for source in sources:
+        source_path, sha1 = source.rsplit(':', 1)
+        if os.path.exists(source_path) and _sha1(source_path) != sha1:
+            changed.append(source_path)
+    return changed
+
+
+def _sha1(path):
+    with open(path, 'rb') as fp:
+        return hashlib.sha1(fp.read()).hexdigest()
+
+
+if __name__ == '__main__':
+    print('Saved %s' % convert_nets(*sys.argv[1:]))
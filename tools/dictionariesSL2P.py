@@ -12,7 +12,10 @@ def define_input_resolution():
     }
     return(RESOLUTION_OPTIONS)
     
-def make_collection_options(fc):  
+# Network, domain and parameter assets are given as loader functions of fc and are only
+# called for the requested collection, so a single collection does not unpickle the others.
+# load=False returns the loader functions themselves (e.g. to locate their files).
+def make_collection_options(fc, imageCollectionName=None, load=True):  
     COLLECTION_OPTIONS = {
         # Sentinel 2 using 20 m bands (Base for 20m network)
         'S2_SR': {
@@ -22,10 +25,10 @@ def make_collection_options(fc):
         "vza": 'MEAN_INCIDENCE_ZENITH_ANGLE_B8A',
         "saa": 'MEAN_SOLAR_AZIMUTH_ANGLE',  
         "vaa": 'MEAN_INCIDENCE_AZIMUTH_ANGLE_B8A',
-        "Collection_SL2P": fc.s2_createFeatureCollection_estimates(),    
-        "Collection_SL2Perrors": fc.s2_createFeatureCollection_errors(),        
-        "sl2pDomain": fc.s2_createFeatureCollection_domains(),    
-        "Network_Ind": fc.s2_createFeatureCollection_Network_Ind(),      
+        "Collection_SL2P": fc.s2_createFeatureCollection_estimates,    
+        "Collection_SL2Perrors": fc.s2_createFeatureCollection_errors,        
+        "sl2pDomain": fc.s2_createFeatureCollection_domains,    
+        "Network_Ind": fc.s2_createFeatureCollection_Network_Ind,      
         "numVariables": 6,
         "exportRes": 20,
         },
@@ -38,10 +41,10 @@ def make_collection_options(fc):
         "vza": 'MEAN_INCIDENCE_ZENITH_ANGLE_B8A',
         "saa": 'MEAN_SOLAR_AZIMUTH_ANGLE',  
         "vaa": 'MEAN_INCIDENCE_AZIMUTH_ANGLE_B8A',
-        "Collection_SL2P": fc.s2_10m_createFeatureCollection_estimates(),
-        "Collection_SL2Perrors": fc.s2_10m_createFeatureCollection_errors(),  
-        "sl2pDomain": fc.s2_10m_createFeatureCollection_domains(),
-        "Network_Ind": fc.s2_10m_createFeatureCollection_Network_Ind(),
+        "Collection_SL2P": fc.s2_10m_createFeatureCollection_estimates,
+        "Collection_SL2Perrors": fc.s2_10m_createFeatureCollection_errors,  
+        "sl2pDomain": fc.s2_10m_createFeatureCollection_domains,
+        "Network_Ind": fc.s2_10m_createFeatureCollection_Network_Ind,
         "numVariables": 6,
         "exportRes": 10,
         },
@@ -55,10 +58,10 @@ def make_collection_options(fc):
         "vza": 'VZA',
         "saa": 'SAA',  
         "vaa": 'VAA',
-        "Collection_SL2P": fc.s2_createFeatureCollection_estimates(),    
-        "Collection_SL2Perrors": fc.s2_createFeatureCollection_errors(),        
-        "sl2pDomain": fc.s2_createFeatureCollection_domains(),    
-        "Network_Ind": fc.s2_createFeatureCollection_Network_Ind(),      
+        "Collection_SL2P": fc.s2_createFeatureCollection_estimates,    
+        "Collection_SL2Perrors": fc.s2_createFeatureCollection_errors,        
+        "sl2pDomain": fc.s2_createFeatureCollection_domains,    
+        "Network_Ind": fc.s2_createFeatureCollection_Network_Ind,      
         "numVariables": 6,
         "exportRes": 20,
         },
@@ -71,14 +74,17 @@ def make_collection_options(fc):
         "vza": 'VZA',
         "saa": 'SAA',
         "vaa": 'VAA',
-        "Collection_SL2P": fc.s2_createFeatureCollection_estimates(),
-        "Collection_SL2Perrors": fc.s2_createFeatureCollection_errors(),  
-        "sl2pDomain": fc.s2_createFeatureCollection_domains(),
-        "Network_Ind": fc.s2_createFeatureCollection_Network_Ind(),
+        "Collection_SL2P": fc.s2_createFeatureCollection_estimates,
+        "Collection_SL2Perrors": fc.s2_createFeatureCollection_errors,  
+        "sl2pDomain": fc.s2_createFeatureCollection_domains,
+        "Network_Ind": fc.s2_createFeatureCollection_Network_Ind,
         "numVariables": 6, 
         "exportRes": 20,
         }
     }
+    names = COLLECTION_OPTIONS.keys() if imageCollectionName is None else [imageCollectionName]
+    COLLECTION_OPTIONS = {name: {key: value() if callable(value) and load else value for key, value in COLLECTION_OPTIONS[name].items()}
+                          for name in names}
     return(COLLECTION_OPTIONS)
 
 
@@ -252,6 +258,23 @@ def make_net_options():
     return(NET_OPTIONS)
 
 
+def make_mask_options():
+    # pixels excluded from SL2P (masked): they are not run through the nets and their
+    # estimate/uncertainty are set to outputNodata and both flags to maskedFlag
+    MASK_OPTIONS = {
+        # FORCE BOA nodata value
+        "inputNodata": -9999,
+        # FORCE QAI bits that mask a pixel: 0 nodata, 1-2 cloud state, 3 cloud shadow, 4 snow, 5 water
+        "qaiInvalidBits": 0b111111,
+        # Sentinel-2 L2A SCL classes that mask a pixel: no data, saturated, cloud shadow, water,
+        # cloud medium/high probability, thin cirrus, snow
+        "sclInvalidClasses": [0, 1, 3, 6, 8, 9, 10, 11],
+        "outputNodata": -9999,
+        "maskedFlag": 2,
+    }
+    return(MASK_OPTIONS)
+
+
 def make_outputParams():
     # output parameters (No changes)
     outputParams = {
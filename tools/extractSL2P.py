@@ -0,0 +1,247 @@
+# extractSL2P.py
+
+# SL2P at points or within small polygons of a FORCE tile (validation plots, field sites),
+# without reading the tile or running the nets on every pixel:
+#   - the coordinates (any CRS, GPS longitude/latitude by default) are mapped to pixel
+#     indices with the transform of the tile
+#   - the pixels are grouped by the internal block of the band files and each group is read
+#     as the smallest window covering it (GDAL only decodes the blocks touched)
+#   - the angle cosines are interpolated at the pixels from the (coarse) angle rasters
+#   - the domain check and the nets run on that sparse set only (SL2P_multi on a 1 x n input)
+# The result is a table: a dict of 1D columns, one row per pixel, with the id of the point or
+# polygon, the pixel position, and the estimate, uncertainty and output flag of every
+# variable plus the input flag (write_csv writes it out).
+#
+# Usage: python -m tools.extractSL2P tile_dir --points points.csv -o table.csv
+#        (points.csv: x,y columns, longitude/latitude unless --crs), or --polygons file.geojson
+
+import argparse
+import csv
+import json
+import logging
+import os
+import numpy
+import rasterio
+from rasterio.crs import CRS
+from rasterio.features import geometry_mask
+from rasterio.transform import rowcol
+from rasterio.warp import transform, transform_geom
+from rasterio.windows import Window, from_bounds
+from tools import SL2P
+from tools import registrySL2P
+from tools import dictionariesSL2P
+from tools import angleFields
+from tools import profileSL2P
+from tools import toolsNets
+from tools.read_sentinel2_force_image import force_band_files, read_force_profile
+from tools.read_sentinel2_safe_image import read_band_files
+
+logger = logging.getLogger(__name__)
+
+ANGLE_FILES = {'SZA': 'sun_zenith_degrees.tif', 'SAA': 'sun_azimuth_degrees.tif',
+               'VZA': 'sensor_zenith_degrees.tif', 'VAA': 'sensor_azimuth_degrees.tif'}
+
+
+def pixel_indices(profile, xs, ys, crs='EPSG:4326'):
+    """
+    Return the (rows, cols) pixel indices of the points xs, ys (in crs) in the raster described
+    by profile, and the boolean array of the points inside it.
+    """
+    xs, ys = numpy.asarray(xs, dtype=numpy.float64), numpy.asarray(ys, dtype=numpy.float64)
+    if crs is not None and CRS.from_user_input(crs) != profile['crs']:
+        xs, ys = (numpy.asarray(values) for values in transform(crs, profile['crs'], xs, ys))
+    rows, cols = (numpy.asarray(values, dtype=numpy.int64).reshape(-1) for values in rowcol(profile['transform'], xs, ys))
+    inside = (rows >= 0) & (rows < profile['height']) & (cols >= 0) & (cols < profile['width'])
+    return rows, cols, inside
+
+
+def read_pixels(path, rows, cols, dtype=None):
+    """
+    Read the values of the pixels (rows, cols) of the first band of path: the pixels are
+    grouped by the internal block of the file and each group is read as one window.
+    """
+    with rasterio.open(path) as src:
+        block_rows, block_cols = src.block_shapes[0]
+        values = numpy.empty(len(rows), dtype=dtype or src.dtypes[0])
+        groups = {}
+        for index, key in enumerate(zip(rows // block_rows, cols // block_cols)):
+            groups.setdefault(key, []).append(index)
+        for indices in groups.values():
+            indices = numpy.array(indices)
+            row_off, col_off = rows[indices].min(), cols[indices].min()
+            window = Window(col_off, row_off, cols[indices].max() - col_off + 1, rows[indices].max() - row_off + 1)
+            values[indices] = src.read(1, window=window)[rows[indices] - row_off, cols[indices] - col_off]
+    return values
+
+
+def read_angle_cosines(tile_dir, rows, cols, shape):
+    """Return the cosSZA, cosVZA and cosRAA of the pixels (rows, cols) of a FORCE tile of shape (rows, cols)."""
+    angles = {}
+    for key, fname in ANGLE_FILES.items():
+        path = os.path.join(tile_dir, fname)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Missing required angle file {fname} in {tile_dir}.")
+        with rasterio.open(path) as src:
+            if (src.height, src.width) == tuple(shape):
+                angles[key] = read_pixels(path, rows, cols, numpy.float64)
+            else:
+                angles[key] = src.read(1).astype(numpy.float64)
+    if all(values.ndim == 1 for values in angles.values()):
+        return angleFields.cosine_grids(**angles)
+    # coarse angle rasters cover the extent of the tile: cosines are computed on the coarse
+    # grid and interpolated at the pixel centres (as angleFields.interp_window)
+    cosines = {}
+    for key, grid in angleFields.cosine_grids(**angles).items():
+        cosines[key] = angleFields.interp_points(grid, (rows + 0.5) * grid.shape[0] / shape[0] - 0.5,
+                                                 (cols + 0.5) * grid.shape[1] / shape[1] - 0.5)
+    return cosines
+
+
+def extract_pixels(tile_dir, rows, cols, imageCollectionName='S2_FORCE', variables=None, backend='float64', io_workers=None):
+    """
+    Run SL2P on the pixels (rows, cols) of a FORCE tile only. Returns the table of the pixels
+    (see the module header) without the id column.
+    """
+    if variables is None:
+        variables = list(dictionariesSL2P.make_outputParams().keys())
+    rows, cols = numpy.asarray(rows, dtype=numpy.int64), numpy.asarray(cols, dtype=numpy.int64)
+    netOptions = registrySL2P.get_net_options(variables[0], imageCollectionName)
+    profile = read_force_profile(tile_dir)
+    band_files = force_band_files(tile_dir)
+    bands = [band for band in netOptions['inputBands'] if band.startswith('B')] + (['QAI'] if 'QAI' in band_files else [])
+    missing = [band for band in bands if band not in band_files]
+    if missing:
+        raise FileNotFoundError(f"Missing bands {missing} in FORCE tile {tile_dir}.")
+
+    # the sparse pixels as a 1 x n image
+    with profileSL2P.stage('read', len(rows) * len(bands)):
+        values = read_band_files([band_files[band] for band in bands], lambda path: read_pixels(path, rows, cols), io_workers)
+        s2 = {band: band_values[None, :] for band, band_values in zip(bands, values)}
+    with profileSL2P.stage('angles', len(rows)):
+        s2.update({key: cosine[None, :] for key, cosine in read_angle_cosines(tile_dir, rows, cols, (profile['height'], profile['width'])).items()})
+    sl2p_inp = SL2P.prepare_sl2p_inp(s2, variables[0], imageCollectionName)
+    mask = SL2P.make_valid_mask(s2, variables[0], imageCollectionName)
+    varmap = SL2P.SL2P_multi(sl2p_inp, imageCollectionName, variables, mask=mask, backend=backend)
+
+    xs, ys = rasterio.transform.xy(profile['transform'], rows, cols)
+    table = {'row': rows, 'col': cols, 'x': numpy.asarray(xs, dtype=numpy.float64).reshape(-1),
+             'y': numpy.asarray(ys, dtype=numpy.float64).reshape(-1)}
+    table.update({key: value.reshape(-1) for key, value in varmap.items()})
+    return table
+
+
+def extract_points(tile_dir, points, crs='EPSG:4326', imageCollectionName='S2_FORCE', variables=None, backend='float64'):
+    """
+    Run SL2P at points ((x, y) pairs in crs, longitude/latitude by default) of a FORCE tile.
+    Returns the table of the points inside the tile, whose 'id' column holds the index of
+    the point in points.
+    """
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    rows, cols, inside = pixel_indices(read_force_profile(tile_dir), points[:, 0], points[:, 1], crs)
+    if not inside.all():
+        logger.warning('%d of %d points are outside %s', (~inside).sum(), len(points), tile_dir)
+    table = extract_pixels(tile_dir, rows[inside], cols[inside], imageCollectionName, variables, backend)
+    return dict({'id': numpy.flatnonzero(inside)}, **table)
+
+
+def polygon_pixels(profile, geometry, crs='EPSG:4326', all_touched=False):
+    """
+    Return the (rows, cols) of the pixels of the raster described by profile whose centre
+    is inside geometry (a GeoJSON-like geometry or an object with __geo_interface__ in crs;
+    all_touched: every pixel touched instead).
+    """
+    geometry = getattr(geometry, '__geo_interface__', geometry)
+    if crs is not None and CRS.from_user_input(crs) != profile['crs']:
+        geometry = transform_geom(crs, profile['crs'], geometry)
+    coordinates = numpy.array(list(_coordinates(geometry['coordinates'])))
+    window = from_bounds(*coordinates.min(axis=0), *coordinates.max(axis=0), transform=profile['transform'])
+    row_off, col_off = numpy.floor(window.row_off), numpy.floor(window.col_off)
+    window = Window(col_off, row_off, numpy.ceil(window.col_off + window.width) - col_off,
+                    numpy.ceil(window.row_off + window.height) - row_off).intersection(Window(0, 0, profile['width'], profile['height']))
+    inside = ~geometry_mask([geometry], (int(window.height), int(window.width)),
+                            rasterio.windows.transform(window, profile['transform']), all_touched=all_touched)
+    rows, cols = numpy.nonzero(inside)
+    return rows + int(window.row_off), cols + int(window.col_off)
+
+
+def _coordinates(coordinates):
+    if isinstance(coordinates[0], (int, float)):
+        yield coordinates[:2]
+    else:
+        for part in coordinates:
+            yield from _coordinates(part)
+
+
+def extract_polygons(tile_dir, polygons, crs='EPSG:4326', imageCollectionName='S2_FORCE', variables=None,
+                     backend='float64', all_touched=False):
+    """
+    Run SL2P on the pixels of a FORCE tile within polygons (see polygon_pixels). Returns the
+    table of the pixels, whose 'id' column holds the index of their polygon in polygons.
+    """
+    profile = read_force_profile(tile_dir)
+    ids, rows, cols = [], [], []
+    for index, geometry in enumerate(polygons):
+        try:
+            polygon_rows, polygon_cols = polygon_pixels(profile, geometry, crs, all_touched)
+        except rasterio.errors.WindowError:
+            polygon_rows, polygon_cols = numpy.array([], dtype=int), numpy.array([], dtype=int)
+        if not len(polygon_rows):
+            logger.warning('Polygon %d has no pixel in %s', index, tile_dir)
+        ids.append(numpy.full(len(polygon_rows), index))
+        rows.append(polygon_rows)
+        cols.append(polygon_cols)
+    table = extract_pixels(tile_dir, numpy.concatenate(rows), numpy.concatenate(cols), imageCollectionName, variables, backend)
+    return dict({'id': numpy.concatenate(ids)}, **table)
+
+
+def write_csv(table, path):
+    """Write a table returned by extract_points/extract_polygons as CSV (one row per pixel)."""
+    with open(path, 'w', newline='') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(list(table))
+        writer.writerows(zip(*[column.tolist() for column in table.values()]))
+    return path
+
+
+def read_points(path):
+    """Read the (x, y) pairs of the x and y columns of a CSV file."""
+    with open(path, newline='') as fp:
+        return [(float(row['x']), float(row['y'])) for row in csv.DictReader(fp)]
+
+
+def read_polygons(path):
+    """Read the geometries of a GeoJSON file (FeatureCollection, Feature or geometry)."""
+    with open(path) as fp:
+        content = json.load(fp)
+    features = content['features'] if content.get('type') == 'FeatureCollection' else [content]
+    return [feature.get('geometry', feature) for feature in features]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m tools.extractSL2P', description='Run SL2P at points or within polygons of a FORCE tile.')
+    parser.add_argument('tile_dir', help='FORCE tile directory')
+    locations = parser.add_mutually_exclusive_group(required=True)
+    locations.add_argument('--points', help='CSV file with x and y columns')
+    locations.add_argument('--polygons', help='GeoJSON file of polygons')
+    parser.add_argument('-o', '--out', required=True, help='output CSV table')
+    parser.add_argument('--crs', default='EPSG:4326', help='CRS of the coordinates (default EPSG:4326)')
+    parser.add_argument('-c', '--collection', default='S2_FORCE', help='image collection of the networks (default S2_FORCE)')
+    parser.add_argument('-v', '--variables', nargs='+', choices=list(dictionariesSL2P.make_outputParams().keys()),
+                        help='variables to estimate (default: all)')
+    parser.add_argument('--backend', default='float64', choices=toolsNets.BACKENDS, help='inference backend')
+    parser.add_argument('--all-touched', action='store_true', help='use every pixel touched by the polygons')
+    parser.add_argument('-q', '--quiet', action='store_true', help='log warnings and errors only')
+    args = parser.parse_args(argv)
+    profileSL2P.configure_logging(args.quiet)
+    if args.points:
+        table = extract_points(args.tile_dir, read_points(args.points), args.crs, args.collection, args.variables, args.backend)
+    else:
+        table = extract_polygons(args.tile_dir, read_polygons(args.polygons), args.crs, args.collection, args.variables,
+                                 args.backend, args.all_touched)
+    write_csv(table, args.out)
+    logger.info('Wrote %d pixels to %s', len(table['id']), args.out)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
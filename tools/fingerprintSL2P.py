@@ -0,0 +1,109 @@
+# fingerprintSL2P.py
+
+# Fingerprints of SL2P products, so archive reruns only recompute the products whose inputs,
+# networks or options changed (see batchSL2P). A fingerprint has three parts, each a SHA-1:
+#   inputs   the input files (band, QAI, angle and metadata files): path, size and mtime, or
+#            their content with checksum=True (e.g. for archives copied with new mtimes)
+#   model    what SL2P computes the product with: the content of the nets/*.pkl files of the
+#            collection (estimate and error networks, calibration domain, network parameters),
+#            the network index, input bands and scaling of the variable, the output range and
+#            the mask options. The pickles are the source of truth: nets/sl2p_nets.npz is only
+#            used while they are unchanged (see registrySL2P)
+#   options  the options changing the product values or layout (backend, dtype, flags layout)
+# The fingerprint is stored as the SL2P_FINGERPRINT tag of the product (write_sl2p_product
+# tags), so products carry it wherever they are moved.
+
+import hashlib
+import json
+import os
+import rasterio
+from tools import registrySL2P
+from tools import dictionariesSL2P
+from tools import convertNets
+from tools import SL2PV0 as algorithm
+
+FINGERPRINT_TAG = 'SL2P_FINGERPRINT'
+PARTS = ['inputs', 'model', 'options']
+MODEL_ASSETS = ['Collection_SL2P', 'Collection_SL2Perrors', 'sl2pDomain', 'Network_Ind']
+
+
+def _sha1(content):
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def file_checksum(path, block=2 ** 24):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(block), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def inputs_fingerprint(paths, checksum=False):
+    """Fingerprint of the input files paths (size and mtime, or content with checksum=True)."""
+    files = []
+    for path in sorted(os.path.abspath(path) for path in paths):
+        stat = os.stat(path)
+        files.append([path, file_checksum(path)] if checksum else [path, stat.st_size, stat.st_mtime_ns])
+    return _sha1(files)
+
+
+def model_files(imageCollectionName):
+    """Return the nets/*.pkl files SL2P reads the networks, domain and parameters of imageCollectionName from."""
+    colOptions = dictionariesSL2P.make_collection_options(algorithm, imageCollectionName, load=False)[imageCollectionName]
+    return sorted({algorithm.asset_path(colOptions[asset]) for asset in MODEL_ASSETS})
+
+
+def model_fingerprint(imageCollectionName, variableName):
+    """Fingerprint of the network files and options SL2P uses for variableName in imageCollectionName (memoized by registrySL2P)."""
+    return registrySL2P.get_model_fingerprint(imageCollectionName, variableName, _model_fingerprint)
+
+
+def _model_fingerprint(imageCollectionName, variableName):
+    files = []
+    for path in model_files(imageCollectionName):
+        if os.path.exists(path):
+            files.append([path, file_checksum(path)])
+        elif os.path.exists(convertNets.NETS_FILE):
+            # pickles not shipped: the precompiled networks are the only source
+            files.append([convertNets.NETS_FILE, file_checksum(convertNets.NETS_FILE)])
+    netOptions = registrySL2P.get_net_options(variableName, imageCollectionName)
+    return _sha1([files, {option: netOptions[option] for option in ['variable', 'inputBands', 'inputScaling', 'inputOffset']},
+                  dictionariesSL2P.make_outputParams()[variableName],
+                  dictionariesSL2P.make_mask_options()])
+
+
+def product_fingerprint(paths, imageCollectionName, variableName, options=None, checksum=False):
+    """Return the fingerprint ({part: SHA-1}) of the product of variableName computed from the files paths."""
+    return {'inputs': inputs_fingerprint(paths, checksum),
+            'model': model_fingerprint(imageCollectionName, variableName),
+            'options': _sha1(options or {})}
+
+
+def fingerprint_tags(fingerprint):
+    """Return the product tags (write_sl2p_product.open_product tags) storing fingerprint."""
+    return {FINGERPRINT_TAG: json.dumps(fingerprint, sort_keys=True)}
+
+
+def read_fingerprint(path):
+    """Return the fingerprint stored in the product at path, or None."""
+    with rasterio.open(path) as src:
+        tag = src.tags().get(FINGERPRINT_TAG)
+    return json.loads(tag) if tag else None
+
+
+def changes(path, fingerprint):
+    """
+    Return why the product at path must be (re)computed for fingerprint: [] when it is up to
+    date, ['missing'] when there is no product, ['unknown'] when it has no fingerprint, or the
+    changed PARTS.
+    """
+    if not os.path.exists(path):
+        return ['missing']
+    try:
+        stored = read_fingerprint(path)
+    except rasterio.errors.RasterioIOError:
+        return ['missing']
+    if stored is None:
+        return ['unknown']
+    return [part for part in PARTS if stored.get(part) != fingerprint[part]]
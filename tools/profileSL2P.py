@@ -0,0 +1,139 @@
+# profileSL2P.py
+
+# Lightweight instrumentation of the SL2P pipeline:
+#   - stage(name, pixels) context manager timing a stage and counting the pixels it processed
+#     (stages may nest, e.g. 'resample' inside 'read'; times are inclusive)
+#   - the peak resident memory, sampled at the end of every stage: of the run on Linux (reset by
+#     start_run), of the process so far elsewhere (peak_memory_scope 'run' or 'process')
+#   - one structured record per run (start_run/end_run), appended as a JSON line to a log file
+#     with the time, calls, pixels and throughput (Mpix/s) of every stage
+#   - logging of the tools modules (configure_logging, with a quiet mode)
+# Stage statistics are kept per process; streamSL2P.iter_results merges those of its worker
+# processes into the parent (take_stages/merge_stages).
+
+import contextlib
+import json
+import logging
+import os
+import socket
+import sys
+import time
+from datetime import datetime
+try:
+    import resource # peak memory (not available on Windows)
+except ImportError:
+    resource = None
+
+# JSON lines file receiving the run records when end_run is not given a path
+PROFILE_LOG = os.environ.get('SL2P_PROFILE_LOG')
+
+_stages = {}
+_run = None
+
+
+def peak_memory_mb():
+    """
+    Peak resident memory of this process in MB (None where unavailable): since the last
+    reset_peak_memory on Linux, over the lifetime of the process elsewhere.
+    """
+    try:
+        with open('/proc/self/status') as fp:
+            return next(int(line.split()[1]) for line in fp if line.startswith('VmHWM:')) / 1024.
+    except (OSError, StopIteration):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024. * 1024.) if sys.platform == 'darwin' else peak / 1024.
+
+
+def reset_peak_memory():
+    """Reset the peak resident memory of this process to its current value (Linux); returns False where not supported."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+        return True
+    except OSError:
+        return False
+
+
+@contextlib.contextmanager
+def stage(name, pixels=0):
+    """
+    Time the enclosed block as stage name, counting pixels processed pixels. Yields a dict
+    whose 'pixels' the block may increase when the count is only known inside it.
+    """
+    counter = {'pixels': pixels}
+    start = time.perf_counter()
+    try:
+        yield counter
+    finally:
+        entry = _stages.setdefault(name, {'seconds': 0., 'calls': 0, 'pixels': 0})
+        entry['seconds'] += time.perf_counter() - start
+        entry['calls'] += 1
+        entry['pixels'] += int(counter['pixels'])
+        entry['peak_memory_mb'] = peak_memory_mb()
+
+
+def take_stages():
+    """Return and reset the stage statistics of this process (e.g. at the end of a worker task)."""
+    stages = {name: dict(entry) for name, entry in _stages.items()}
+    _stages.clear()
+    return stages
+
+
+def merge_stages(stages):
+    """Add stage statistics returned by take_stages in another process to this process."""
+    for name, other in stages.items():
+        entry = _stages.setdefault(name, {'seconds': 0., 'calls': 0, 'pixels': 0})
+        for key in ['seconds', 'calls', 'pixels']:
+            entry[key] += other[key]
+        entry['peak_memory_mb'] = max(filter(None, [entry.get('peak_memory_mb'), other.get('peak_memory_mb')]), default=None)
+
+
+def start_run(**info):
+    """Start a run record (info: free-form fields such as the collection, tile or variables)."""
+    global _run
+    _stages.clear()
+    # worker processes are reused across runs: the peak memory is measured from here when the
+    # platform allows it, and is otherwise the peak of the process so far
+    scope = 'run' if reset_peak_memory() else 'process'
+    _run = {'info': info, 'start': datetime.now().isoformat(timespec='seconds'), 'perf': time.perf_counter(), 'scope': scope}
+
+
+def end_run(path=None):
+    """
+    Close the current run and return its record; the record is appended as one JSON line to
+    path (or PROFILE_LOG, the SL2P_PROFILE_LOG environment variable) when set.
+    """
+    global _run
+    run = _run or {'info': {}, 'start': None, 'perf': None, 'scope': 'process'}
+    stages = {}
+    for name, entry in take_stages().items():
+        stages[name] = dict(entry, mpix_per_s=entry['pixels'] / 1e6 / entry['seconds'] if entry['pixels'] and entry['seconds'] else None)
+    record = dict(run['info'], start=run['start'], host=socket.gethostname(), pid=os.getpid(),
+                  seconds=time.perf_counter() - run['perf'] if run['perf'] is not None else None,
+                  peak_memory_mb=peak_memory_mb(), peak_memory_scope=run['scope'], stages=stages)
+    _run = None
+    path = path or PROFILE_LOG
+    if path:
+        with open(path, 'a') as fp:
+            fp.write(json.dumps(record) + '\n')
+    return record
+
+
+def configure_logging(quiet=False, level=None):
+    """
+    Send the log messages of the tools modules (and of the module run as a script, e.g.
+    python -m tools.batchSL2P) to stderr: INFO (progress) by default, WARNING only when
+    quiet, or level.
+    """
+    for name in ['__main__', 'tools']:
+        logger = logging.getLogger(name)
+        if not logger.handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+            logger.addHandler(handler)
+        logger.setLevel(level if level is not None else logging.WARNING if quiet else logging.INFO)
+    return logger
@@ -1,12 +1,17 @@
 # read_sentinel2_force_image.py
 
 import rasterio
+from rasterio.windows import Window, from_bounds
 import numpy
 import os
-from tools import read_sentinel2_safe_image # Accesses the original XML parser
-from skimage.transform import resize # For robust upscaling/downsampling
+import logging
+from tools import profileSL2P
+from tools import angleFields # Angle grids from the SAFE XML, evaluated on the TIF grid
+from tools import resampleSL2P # Resampling of the layers onto the output grid
+from tools.read_sentinel2_safe_image import read_band_files # Concurrent band reads
+
+logger = logging.getLogger(__name__)
 
-# NOTE: read_sentinel2_safe_image must now also import 'resize' from skimage.transform
 
 # ====================================================================
 # HELPER FUNCTIONS (Band Mapping)
@@ -40,6 +45,7 @@ def map_force_band_name(fn):
     if 'RE3' in fn: return 'B07'
     if 'SW1' in fn: return 'B11'
     if 'SW2' in fn: return 'B12'
+    if 'QAI' in fn: return 'QAI'
     return fn.split('_')[0] 
 
 
@@ -47,90 +53,67 @@ def map_force_band_name(fn):
 # READER 1: SINGLE TIF + XML ANGLES (Hybrid Zero Offset Mode)
 # ====================================================================
 
-def read_single_tif_xml_angles(tif_path, safe_dir):
+def read_single_tif_xml_angles(tif_path, safe_dir, bands=None, dtype=numpy.float32, res=20, qai_path=None, window=None):
     """
-    Reads spectral data from TIF and angles from SAFE XML, performing a simple
-    pixel-based subsetting to ensure alignment. FINAL output resolution is 20m.
+    Reads spectral data from TIF and angles from SAFE XML, evaluated on the georeferenced
+    pixel grid of the TIF. FINAL output resolution is res (20m).
+    bands: band names to read, e.g. the 'inputBands' of the network (angle names are
+           ignored); None reads every band of the TIF with an SL2P name.
+    dtype: dtype of the returned bands.
+    qai_path: optional FORCE QAI file on the grid of the TIF, read as s2['QAI'].
+    window: optional rasterio Window in output pixels; only that part of the TIF is read
+           and the returned profile describes it.
     """
     s2 = {}
     
-    # --- 1. Get Spectral Data and Target Metadata (3000x3000, 10m) ---
+    # --- 1. Get Spectral Data and Target Metadata ---
     with rasterio.open(tif_path) as src:
         s2['profile'] = src.profile
         
-        # Dimensions of the 10m input image
-        tif_res_10m_height = src.height # 3000
-        tif_res_10m_width = src.width   # 3000
-
-        # *** CHANGE: Loop reads specific indices defined by the TIF structure ***
-        for band_index in range(1, src.count + 1):
-            sl2p_name = map_single_tif_bands(band_index)
-            if sl2p_name in ['B02', 'B03', 'B04', 'B08']:
-                 s2[sl2p_name] = src.read(band_index)
-                 
-    if 'B08' not in s2:
-        raise FileNotFoundError("Missing B08 band in the single TIF. Check band mapping.")
-
-
-    # --- 2. Get Angular Data from the SAFE XML (Full 10980x10980 S2 Tile) ---
-    # *** CHANGE: We force the XML reader to create a FULL 10m tile (10980x10980) ***
-    # This ensures that our 3000x3000px subset is clipped from a high-resolution grid.
-    print("Reading and upscaling full 10m angle grid from SAFE XML...")
-    
-    # The XML is read and resized internally to the FULL 10m tile size (10980x10980).
-    full_s2_10m_size = (10980, 10980) 
-    safe_data = read_sentinel2_safe_image.read_s2(safe_dir, res=10, target_size=full_s2_10m_size) 
-    
-    
-    # --- 3. PIXEL-BASED SUBSETTING (CRITICAL: Clipping the 10980x10980 array) ---
-    # *** CHANGE: Switched from Geospatial to Pixel-based offsets (0,0) ***
-    # This fixed NA artifacts by assuming the subset is at the start of the tile.    
-    col_offset = 0
-    row_offset = 0
-
-    # Define the 3000x3000 slice window
-    clip_slice_rows = slice(row_offset, row_offset + tif_res_10m_height) # 0 to 3000
-    clip_slice_cols = slice(col_offset, col_offset + tif_res_10m_width)   # 0 to 3000
-    
-    print(f"Applying Pixel Clip: Row={row_offset}:{row_offset + tif_res_10m_height}, Col={col_offset}:{col_offset + tif_res_10m_width}")
-
-    # *** CHANGE: Defined the 20m target dimensions (1500x1500px) ***
-    final_20m_shape = (int(tif_res_10m_height / 2), int(tif_res_10m_width / 2)) 
-
-
-    # --- 4. CLIPPING AND FINAL DOWNSAMPLING (10m -> 20m) ---
-    # *** CHANGE: Integrated resize() for every layer to ensure uniform 20m output ***
-    # Process Angles (VZA, VAA, SZA, SAA, SCL)
-    for key in ['SZA', 'SAA', 'VZA', 'VAA', 'SCL']:
-        if key in safe_data:
-            # 4a. Clip the full 10980x10980 angle array to the 3000x3000 subset
-            clipped_array = safe_data[key][clip_slice_rows, clip_slice_cols] 
-            
-            # 4b. Downsample the clipped 3000x3000 array to 1500x1500 (20m)
-            order = 0 if key == 'SCL' else 1
-            s2[key] = resize(clipped_array, final_20m_shape, order=order, preserve_range=True, anti_aliasing=True)
-
-    # *** CHANGE: Downsampling spectral bands to match the 20m grid ***
-    # Process Spectral Bands (B02, B03, B04, B08)
-    for key in ['B02', 'B03', 'B04', 'B08']:
-        if key in s2:
-            # Downsample the 3000x3000 band array to 1500x1500 (20m)
-            s2[key] = resize(s2[key], final_20m_shape, order=1, preserve_range=True, anti_aliasing=True)
-
-    # --- 5. Angle Filling and Final Profile Update ---
-    # *** CHANGE: Fills the remaining NaNs with the mean of valid pixels ***
-    # This prevents the red "NA holes" in the final LAI/fAPAR product.
-    for key in ['VZA', 'VAA']:
-        if key in s2:
-            mean_angle = numpy.nanmean(s2[key])
-            s2[key] = numpy.nan_to_num(s2[key], nan=mean_angle if not numpy.isnan(mean_angle) else 0.0)
-
-    # *** CHANGE: Updated profile transform for 20m georeferencing ***
-    # tif_transform * scale(2) doubles the pixel size in the metadata.
+        # *** CHANGE: The output grid is derived from the georeferencing of the TIF (resampleSL2P.target_grid) ***
+        # It starts at the upper-left corner of the TIF whatever its resolution or offset within
+        # the S2 tile, so no pixel offset or 10m input is assumed.
+        grid = resampleSL2P.target_grid(src.profile, res, window)
+
+        # *** CHANGE: Only the band indices the network needs are read, in one call, straight onto the output grid ***
+        # GDAL reduces 10m -> 20m while decoding (average of the source pixels, nodata excluded),
+        # so no full resolution copy or float64 resize of any band is made. The returned bands
+        # are views into the stack.
+        index_of = {map_single_tif_bands(band_index): band_index for band_index in range(1, src.count + 1)}
+        index_of.pop(None, None)
+        names = [band for band in index_of] if bands is None else [band for band in bands if band.startswith('B')]
+        missing = [band for band in names if band not in index_of]
+        if missing:
+            raise FileNotFoundError(f"Missing bands {missing} in the single TIF. Check band mapping.")
+        with profileSL2P.stage('read', len(names) * grid[1][0] * grid[1][1]):
+            stack = resampleSL2P.read_to_grid(src, [index_of[band] for band in names], grid, 'reflectance', dtype=dtype)
+        for band_id, band in enumerate(names):
+            s2[band] = stack[band_id]
+
+    if qai_path is not None:
+        with rasterio.open(qai_path) as src, profileSL2P.stage('read', grid[1][0] * grid[1][1]):
+            s2['QAI'] = resampleSL2P.read_to_grid(src, [1], grid, 'class', dtype=src.dtypes[0])[0]
+
+    # --- 2. Get Angular Data from the SAFE XML (23x23 grids of the S2 Tile) ---
+    # *** CHANGE: The angle grids are evaluated bilinearly at the pixel centres of the output grid ***
+    # The grid nodes are located with the tile ULX/ULY and COL_STEP/ROW_STEP, so the TIF may be
+    # any subset of the tile and no full 10980x10980 angle array is ever built.
+    # The cosines used by SL2P are computed on the 23x23 grid and only they are evaluated
+    # (sun and view grids share the same nodes).
+    logger.info('Evaluating angle grids from SAFE XML on the output grid')
+    MTD_TL = os.path.join(safe_dir, 'GRANULE', os.listdir(os.path.join(safe_dir, 'GRANULE'))[0], 'MTD_TL.xml')
+    with profileSL2P.stage('angles', grid[1][0] * grid[1][1]):
+        fields = angleFields.read_angle_fields(MTD_TL)
+        cosines = angleFields.cosine_grids(*[fields[key]['values'] for key in ['SZA', 'SAA', 'VZA', 'VAA']])
+        for key, values in cosines.items():
+            s2[key] = angleFields.evaluate_field(dict(fields['SZA'], values=values), *grid)
+
+    # --- 3. Final Profile Update ---
+    # NaN cells of the view angle grids (outside the detectors) are filled in angleFields.
     s2['profile'].update({
-        'width': final_20m_shape[1], 
-        'height': final_20m_shape[0],
-        'transform': s2['profile']['transform'] * s2['profile']['transform'].from_scale(2, 2)
+        'width': grid[1][1], 
+        'height': grid[1][0],
+        'transform': grid[0]
     })
     
     return s2    
@@ -139,34 +122,101 @@ def read_single_tif_xml_angles(tif_path, safe_dir):
 # READER 2: FORCE ARD TIFFS (Original FORCE Mode)
 # ====================================================================
 
-def read_s2_force(tile_dir):
-    """Read FORCE S2 tile TIFFs and sun/sensor angle files."""
-    s2 = {}
+def force_band_files(tile_dir):
+    """Return {band name: path} of the spectral band TIFFs of a FORCE tile directory."""
+    return {map_force_band_name(fn): os.path.join(tile_dir, fn) for fn in sorted(os.listdir(tile_dir))
+            if fn.endswith(".tif") and not fn.startswith(("sun_", "sensor"))}
 
-    # 1. Read all spectral bands
-    for fn in os.listdir(tile_dir):
-        if fn.endswith(".tif") and not fn.startswith(("sun_", "sensor:")):
-            band_name = map_force_band_name(fn)
-            path = os.path.join(tile_dir, fn)
-            with rasterio.open(path) as src:
-                s2[band_name] = src.read(1)
-                s2['profile'] = src.profile
+def force_window(tile_dir, window=None, bounds=None):
+    """
+    Return the pixel window of a FORCE tile to read: window (rasterio.windows.Window, in band
+    pixels) as given, or the window covering bounds (left, bottom, right, top in the CRS of the
+    tile) snapped to whole pixels and clipped to the tile. None means the whole tile.
+    """
+    if bounds is None:
+        return window
+    path = next(path for band, path in force_band_files(tile_dir).items() if band.startswith('B'))
+    with rasterio.open(path) as src:
+        window = from_bounds(*bounds, transform=src.transform).round_offsets().round_lengths()
+        return window.intersection(Window(0, 0, src.width, src.height))
+
+def read_force_profile(tile_dir, window=None):
+    """Return the rasterio profile of a FORCE tile (of window, if given) without reading any pixels."""
+    path = next(path for band, path in force_band_files(tile_dir).items() if band.startswith('B'))
+    with rasterio.open(path) as src:
+        profile = src.profile
+        if window is not None:
+            profile.update({'width': int(window.width), 'height': int(window.height),
+                            'transform': src.window_transform(window)})
+    return profile
+
+def read_s2_force(tile_dir, bands=None, window=None, bounds=None, dtype=None, io_workers=None):
+    """
+    Read FORCE S2 tile TIFFs and sun/sensor angle files.
+    bands: band names to read, e.g. the 'inputBands' of the network from make_net_options
+           (angle/cosine names in the list are ignored, QAI is always read when present);
+           None reads every band of the tile.
+    window: rasterio.windows.Window in band pixels, or bounds: (left, bottom, right, top) in
+           the CRS of the tile; only that part of the tile is read and the returned profile
+           describes it.
+    dtype: numpy dtype of the returned band arrays (default: the dtype of the files).
+    io_workers: number of band files read concurrently (read_sentinel2_safe_image.IO_WORKERS if None).
+    """
+    s2 = {}
+    window = force_window(tile_dir, window, bounds)
+
+    # 1. Read the requested spectral bands (and QAI) only
+    band_files = force_band_files(tile_dir)
+    if bands is not None:
+        missing = [band for band in bands if band.startswith('B') and band not in band_files]
+        if missing:
+            raise FileNotFoundError(f"Missing bands {missing} in FORCE tile {tile_dir}.")
+        band_files = {band: path for band, path in band_files.items() if band in bands or band == 'QAI'}
+    if not any(band.startswith('B') for band in band_files):
+        raise ValueError(f"No spectral band to read in FORCE tile {tile_dir} (bands={bands}).")
+    def read_band(band_name):
+        with rasterio.open(band_files[band_name]) as src:
+            return src.read(1, window=window, out_dtype=dtype if band_name != 'QAI' else None)
+    with profileSL2P.stage('read') as counter:
+        for band_name, band in zip(band_files, read_band_files(list(band_files), read_band, io_workers)):
+            s2[band_name] = band
+            counter['pixels'] += band.size
+    s2['profile'] = read_force_profile(tile_dir, window)
+    tile_profile = read_force_profile(tile_dir)
+    tile_shape = (tile_profile['height'], tile_profile['width'])
 
     # 2. Read sun and sensor angles (Angle GeoTIFFs)
     angle_files = {
         'SZA': 'sun_zenith_degrees.tif', 'SAA': 'sun_azimuth_degrees.tif',
         'VZA': 'sensor_zenith_degrees.tif', 'VAA': 'sensor_azimuth_degrees.tif'
     }
-    for key, fname in angle_files.items():
-        path = os.path.join(tile_dir, fname)
-        if os.path.exists(path):
+    coarse = {}
+    with profileSL2P.stage('angles', s2['profile']['height'] * s2['profile']['width']):
+        for key, fname in angle_files.items():
+            path = os.path.join(tile_dir, fname)
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Missing required angle file {fname} in {tile_dir}.")
             with rasterio.open(path) as src:
-                 s2[key] = src.read(1)
+                if (src.height, src.width) == tile_shape:
+                    s2[key] = src.read(1, window=window)
+                else:
+                    coarse[key] = src.read(1)
+
+        # Angle rasters coarser than the bands are returned as is for a whole tile (prepare_sl2p_inp
+        # computes the cosines on the coarse grid), and for a window the cosines are computed on the
+        # coarse grid and only interpolated over the window. Both need the four rasters on one grid:
+        # azimuths cannot be interpolated on their own across the 0/360 wrap.
+        if coarse and (len(coarse) != len(angle_files) or len({grid.shape for grid in coarse.values()}) > 1):
+            raise ValueError(f"The angle files of {tile_dir} are not all on one grid (coarse: {sorted(coarse)}).")
+        if window is not None and coarse:
+            for key, grid in angleFields.cosine_grids(**coarse).items():
+                s2[key] = angleFields.interp_window(grid, tile_shape, window)
         else:
-            print(f"Warning: Missing required angle file {fname} for FORCE mode.")
+            s2.update(coarse)
 
-    # 3. Add a dummy SCL if necessary (FORCE ARD usually includes QM, but using a dummy ensures compliance)
-    if 'B02' in s2 and 'SCL' not in s2:
-        s2['SCL'] = numpy.zeros_like(s2['B02'], dtype=numpy.uint8) 
+    # 3. The FORCE quality layer (QAI) is read with the bands when present in tile_dir;
+    # SL2P.make_valid_mask uses it to skip nodata, cloud, shadow, snow and water pixels.
+    if 'QAI' not in s2:
+        logger.warning('No QAI file in %s, only nodata pixels will be masked.', tile_dir)
 
     return s2
\ No newline at end of file
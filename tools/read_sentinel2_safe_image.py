@@ -2,15 +2,43 @@
 
 import numpy, os
 import rasterio
-from skimage.transform import resize # *** CHANGE: Switched from scipy.ndimage.zoom to skimage.resize for high-factor upscaling stability ***
+from concurrent.futures import ThreadPoolExecutor
+from tools import resampleSL2P # *** CHANGE: GDAL resampling (bilinear for angles) instead of skimage.resize ***
 import xml.etree.ElementTree as ET
+import logging
+from functools import lru_cache
 from tqdm import tqdm
 import scipy.ndimage
 # NOTE: scipy.ndimage is kept but now ONLY used for the small-factor resampling in the old flow.
+from tools import profileSL2P
+
+logger = logging.getLogger(__name__)
+
+# number of band files read concurrently by the readers (GDAL releases the GIL while decoding,
+# so JPEG2000 and network filesystem reads overlap); set SL2P_IO_WORKERS to tune it to the storage
+IO_WORKERS = int(os.environ.get('SL2P_IO_WORKERS', 4))
+
+def read_band_files(paths, read_band, io_workers=None, progress=False):
+    """
+    Call read_band(path) for every path in paths with a pool of io_workers threads
+    (IO_WORKERS if None, sequential if <= 1) and return the results in the order of paths.
+    read_band must open its own dataset: rasterio datasets are not shared between threads.
+    """
+    io_workers = IO_WORKERS if io_workers is None else io_workers
+    wrap = (lambda results: tqdm(results, total=len(paths))) if progress else iter
+    if io_workers <= 1 or len(paths) <= 1:
+        return [result for result in wrap(map(read_band, paths))]
+    with ThreadPoolExecutor(max_workers=min(io_workers, len(paths))) as pool:
+        return [result for result in wrap(pool.map(read_band, paths))]
+
+def _read_jp2(fn):
+    with rasterio.open(fn) as src:
+        return src.profile, src.read(1)
 
 # read Sentinel-2 image in SAFE format and return it as a dictionary
 # *** CHANGE: Added target_size parameter to allow the reader to upscale angles immediately to the image resolution ***
-def read_s2(safe, res, target_size=None):
+# *** CHANGE: Band files are read concurrently (io_workers threads, see read_band_files) ***
+def read_s2(safe, res, target_size=None, io_workers=None):
     """
     Reads SAFE spectral data, extracts angles from XMLs, and applies resizing.
     The target_size (H, W) is used to force the angle grid resize, avoiding MemoryError.
@@ -19,15 +47,18 @@ def read_s2(safe, res, target_size=None):
     MTD_TL=safe+'/GRANULE/%s/MTD_TL.xml'%(os.listdir(safe+'/GRANULE/')[0])
     
     s2={}
-    print('Reading Sentinel-2 image')
-    for fn in tqdm([os.path.join(inpath,f) for f in os.listdir(inpath) if f.endswith('.jp2')]): 
-        with rasterio.open(fn) as src:
-            s2.update({'profile':src.profile})
-            s2.update({fn.split('_')[-2]:src.read(1)}) 
+    logger.info('Reading Sentinel-2 image')
+    fns=[os.path.join(inpath,f) for f in os.listdir(inpath) if f.endswith('.jp2')]
+    with profileSL2P.stage('read') as counter:
+        for fn,(profile,band) in zip(fns,read_band_files(fns,_read_jp2,io_workers,progress=True)):
+            s2.update({'profile':profile})
+            s2.update({fn.split('_')[-2]:band})
+            counter['pixels']+=band.size
             
     # *** CHANGE: Passed target_size into extraction calls so resizing happens INSIDE the XML reader ***
-    (SZA, SAA, colstep,rowstep)=extract_sun_angles(MTD_TL, target_size)
-    (VZA, VAA, colstep,rowstep)=extract_sensor_angles(MTD_TL, target_size)
+    with profileSL2P.stage('angles'):
+        (SZA, SAA, colstep,rowstep)=extract_sun_angles(MTD_TL, target_size)
+        (VZA, VAA, colstep,rowstep)=extract_sensor_angles(MTD_TL, target_size)
     s2.update({'SZA':SZA,'SAA':SAA,'VZA':VZA,'VAA':VAA})
     s2['profile'].update({'count':len(s2)-1})
     return s2
@@ -36,145 +67,126 @@ def read_s2(safe, res, target_size=None):
 # *** CHANGE: Added target_size parameter ***
 def extract_sun_angles(xml, target_size=None):
     """Extract Sentinel-2 solar angle bands values from MTD_TL.xml and resize to target_size."""
-    
-    # --- FIX 1: Initialize all variables in function's local scope ---
-    # *** CHANGE: Initializing variables prevents 'UnboundLocalError' if XML tags are missing ***
-    solar_zenith_values = numpy.empty((23,23,)) * numpy.nan 
-    solar_azimuth_values = numpy.empty((23,23,)) * numpy.nan
-    colstep = 0.0 
-    rowstep = 0.0 
-    zenith = None; azimuth = None # Initialized for logic flow
-
-    # Parse the XML file
-    tree = ET.parse(xml)
-    root = tree.getroot()
-
-    # Find the angles (parsing logic)
-    for child in root:
-        if child.tag[-14:] == 'Geometric_Info':
-            geoinfo = child
-
-    for segment in geoinfo:
-        if segment.tag == 'Tile_Angles':
-            angles = segment
-
-    for angle in angles:
-        if angle.tag == 'Sun_Angles_Grid':
-            for bset in angle:
-                if bset.tag == 'Zenith':
-                    zenith = bset
-                if bset.tag == 'Azimuth':
-                    azimuth = bset
-
-            if zenith and azimuth: # Check if Zenith and Azimuth were found
-                # Get Values_List and steps (simplified flow control)
-                zvallist = next((field for field in zenith if field.tag == 'Values_List'), None)
-                avallist = next((field for field in azimuth if field.tag == 'Values_List'), None)
-                
-                # NOTE: Simplified reading of colstep/rowstep could be here if XML structure requires it
-
-                if zvallist and avallist:
-                    for rindex in range(len(zvallist)):
-                        zvalrow = zvallist[rindex]
-                        avalrow = avallist[rindex]
-                        zvalues = zvalrow.text.split(' ')
-                        avalues = avalrow.text.split(' ')
-                        values = list(zip(zvalues, avalues))
-                        
-                        for cindex in range(len(values)):
-                            if ( values[cindex][0] != 'NaN' and values[cindex][1] != 'NaN'):
-                                zen = float(values[cindex][0])
-                                az = float(values[cindex][1])
-                                solar_zenith_values[rindex,cindex] = zen
-                                solar_azimuth_values[rindex,cindex] = az
+    (solar_zenith_values, solar_azimuth_values, colstep, rowstep) = parse_sun_angles(xml)
 
     # --- FINAL RESIZING LOGIC (Uses target_size for robustness) ---
     # *** CHANGE: Dynamically determine shape based on whether we are subsetting (target_size) or using standard tile (22x22) ***
     final_shape = target_size if target_size is not None else (22, 22)
         
-    # *** CHANGE: skimage.resize handles the 136x upscaling factor without MemoryError ***
-    solar_zenith_values = resize(solar_zenith_values, final_shape, preserve_range=True) 
-    solar_azimuth_values = resize(solar_azimuth_values, final_shape, preserve_range=True)
+    # *** CHANGE: GDAL bilinear resampling (resampleSL2P) handles the 136x upscaling factor without MemoryError ***
+    solar_zenith_values = resampleSL2P.resample_to_shape(solar_zenith_values, final_shape, 'angle')
+    solar_azimuth_values = resampleSL2P.resample_to_shape(solar_azimuth_values, final_shape, 'angle')
     
     return (solar_zenith_values, solar_azimuth_values,colstep,rowstep)
 
+def parse_sun_angles(xml):
+    """Parse the 23x23 Sentinel-2 solar angle grids and their COL_STEP/ROW_STEP (metres) from MTD_TL.xml."""
+    angles = parse_tile_angles(xml)
+    return (angles['SZA'].copy(), angles['SAA'].copy(), angles['sun_colstep'], angles['sun_rowstep'])
+
 # extract sensor view and azimuth angles from xml file saved in Sentinel-2 SAFE data
 # *** CHANGE: Added target_size parameter ***
 def extract_sensor_angles(xml, target_size=None):
     """Extract Sentinel-2 view (sensor) angle bands values from MTD_TL.xml and resize to target_size."""
-    
-    numband = 13
-    
-    # --- FIX 1: Initialize all variables in function's local scope ---
-    # *** CHANGE: Ensures arrays and scalars exist even if the Viewing_Incidence loops are skipped ***
-    sensor_zenith_values = numpy.empty((numband,23,23)) * numpy.nan 
-    sensor_azimuth_values = numpy.empty((numband,23,23)) * numpy.nan
-    colstep = 0.0 # Initializing scalars
-    rowstep = 0.0 # Initializing scalars
-
-    # Parse the XML file
-    tree = ET.parse(xml)
-    root = tree.getroot()
-
-    # Find the angles
-    for child in root:
-        if child.tag[-14:] == 'Geometric_Info':
-            geoinfo = child
-
-    for segment in geoinfo:
-        if segment.tag == 'Tile_Angles':
-            angles = segment
-
-    for angle in angles:
-        if angle.tag == 'Viewing_Incidence_Angles_Grids':
-            bandId = int(angle.attrib['bandId'])
-            
-            # FIX 2: Initialize local variables for inner blocks
-            zenith = None 
-            azimuth = None
-            
-            for bset in angle:
-                if bset.tag == 'Zenith':
-                    zenith = bset
-                if bset.tag == 'Azimuth':
-                    azimuth = bset
-            
-            # Get step sizes (which are siblings to Zenith/Azimuth blocks in the XML)
-            for field in angle:
-                if field.tag == 'COL_STEP':
-                    colstep= float(field.text)
-                if field.tag == 'ROW_STEP':
-                    rowstep= float(field.text) 
-                    
-            if zenith and azimuth:
-                zvallist = next((field for field in zenith if field.tag == 'Values_List'), None)
-                avallist = next((field for field in azimuth if field.tag == 'Values_List'), None)
-            
-                if zvallist and avallist:
-                    for rindex in range(len(zvallist)):
-                        zvalrow = zvallist[rindex]
-                        avalrow = avallist[rindex]
-                        zvalues = zvalrow.text.split(' ')
-                        avalues = avalrow.text.split(' ')
-                        values = list(zip(zvalues, avalues ))
-                        
-                        for cindex in range(len(values)):
-                            if (values[cindex][0] != 'NaN' and values[cindex][1] != 'NaN'):
-                                zen = float(values[cindex][0])
-                                az = float(values[cindex][1])
-                                sensor_zenith_values[bandId, rindex,cindex] = zen
-                                sensor_azimuth_values[bandId, rindex,cindex] = az
+    (sensor_zenith_values, sensor_azimuth_values, colstep, rowstep) = parse_sensor_angles(xml)
 
     # --- Final Resizing Logic (Robustly handles target_size) ---
     final_shape = target_size if target_size is not None else (22, 22)
         
-    # *** CHANGE: Explicitly selected Band 8A (Index 7) as the angle reference before resizing ***
-    # *** CHANGE: resize() provides smooth bilinear interpolation across the 3000x3000px BOA area ***
-    sensor_zenith_values = resize(sensor_zenith_values[7], final_shape, preserve_range=True)
-    sensor_azimuth_values = resize(sensor_azimuth_values[7], final_shape, preserve_range=True)
+    # *** CHANGE: resampleSL2P provides smooth bilinear interpolation across the 3000x3000px BOA area ***
+    sensor_zenith_values = resampleSL2P.resample_to_shape(sensor_zenith_values, final_shape, 'angle')
+    sensor_azimuth_values = resampleSL2P.resample_to_shape(sensor_azimuth_values, final_shape, 'angle')
     
     return(sensor_zenith_values, sensor_azimuth_values,colstep,rowstep)
 
+def parse_sensor_angles(xml):
+    """
+    Parse the 23x23 Sentinel-2 view angle grids of the reference band, merged over the
+    detectors, and their COL_STEP/ROW_STEP (metres) from MTD_TL.xml.
+    """
+    angles = parse_tile_angles(xml)
+    return (angles['VZA'].copy(), angles['VAA'].copy(), angles['view_colstep'], angles['view_rowstep'])
+
+def parse_tile_geoposition(xml, res=10):
+    """Return the (ULX, ULY) map coordinates of the tile for the given resolution from MTD_TL.xml."""
+    geopositions = parse_tile_angles(xml)['geopositions']
+    if res not in geopositions:
+        raise ValueError('No Geoposition for resolution %s in %s' % (res, xml))
+    return geopositions[res]
+
+# *** CHANGE: One single-pass parser of MTD_TL.xml shared by the sun, sensor and geoposition readers ***
+def parse_tile_angles(xml, band_id=7):
+    """
+    Parse every angle grid of MTD_TL.xml in one pass. Returns a dict with
+      'SZA', 'SAA'                 : sun zenith/azimuth grids
+      'VZA', 'VAA'                 : view zenith/azimuth grids of band_id (7 = B8A, the angle
+                                     reference of SL2P), merged over the detectors
+      'view_bands'                 : {bandId: (zenith, azimuth)} merged grids of every band
+      'sun_colstep', 'sun_rowstep', 'view_colstep', 'view_rowstep' : grid steps (metres)
+      'geopositions'               : {resolution: (ULX, ULY)}
+    Grids missing from the file are 23x23 NaN grids. Results are memoized on (path, modification time): the arrays are shared between
+    callers and must not be modified in place.
+    """
+    path = os.path.abspath(xml)
+    angles = _parse_tile_angles(path, os.path.getmtime(path))
+    # without viewing grids for band_id the view angles are NaN grids, as the sun grids when missing
+    zenith, azimuth = angles['view_bands'].get(band_id, (angles['nan_grid'], angles['nan_grid']))
+    return dict(angles, VZA=zenith, VAA=azimuth)
+
+@lru_cache(maxsize=256)
+def _parse_tile_angles(path, mtime):
+    grids = {}        # (grid, 'Zenith'|'Azimuth') -> values, grid = 'sun' or (bandId, detectorId)
+    steps = {}        # ('sun'|'view', 'COL_STEP'|'ROW_STEP') -> metres
+    geopositions = {}
+    grid = None; angle = None
+    # iterparse visits each element once; only the Values_List, step and Geoposition
+    # elements are converted and finished grids are cleared to keep the tree small
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        tag = elem.tag.rsplit('}', 1)[-1]
+        if event == 'start':
+            if tag == 'Sun_Angles_Grid':
+                grid = 'sun'
+            elif tag == 'Viewing_Incidence_Angles_Grids':
+                grid = (int(elem.attrib['bandId']), int(elem.attrib['detectorId']))
+            elif tag in ('Zenith', 'Azimuth') and grid is not None:
+                angle = tag
+        elif tag == 'Values_List' and angle is not None:
+            rows = [row.text for row in elem]
+            # vectorized conversion of the whole grid ('NaN' cells parse to nan)
+            grids[(grid, angle)] = numpy.array(' '.join(rows).split(), dtype=numpy.float64).reshape(len(rows), -1)
+        elif tag in ('COL_STEP', 'ROW_STEP') and angle is not None:
+            steps[('sun' if grid == 'sun' else 'view', tag)] = float(elem.text)
+        elif tag == 'Geoposition':
+            geopositions[int(elem.attrib['resolution'])] = (float(elem.find('ULX').text), float(elem.find('ULY').text))
+        elif tag in ('Zenith', 'Azimuth'):
+            angle = None
+        elif tag in ('Sun_Angles_Grid', 'Viewing_Incidence_Angles_Grids'):
+            grid = None
+            elem.clear()
+
+    # Each detector only covers part of the tile (NaN elsewhere) and neighbouring detectors
+    # overlap on a few grid cells. Odd and even detectors look in opposite directions, so the
+    # angles of a cell are taken from a single detector, never averaged: as in the original
+    # parser, the last detector of the file with both a zenith and an azimuth value wins.
+    view_bands = {}
+    for band in sorted({key[0][0] for key in grids if key[0] != 'sun'}):
+        detectors = [key[0] for key in grids if key[0] != 'sun' and key[0][0] == band and key[1] == 'Zenith']
+        zenith = numpy.full(grids[(detectors[0], 'Zenith')].shape, numpy.nan)
+        azimuth = numpy.full(zenith.shape, numpy.nan)
+        for detector in detectors:
+            if (detector, 'Azimuth') not in grids:
+                continue
+            valid = ~numpy.isnan(grids[(detector, 'Zenith')]) & ~numpy.isnan(grids[(detector, 'Azimuth')])
+            zenith[valid] = grids[(detector, 'Zenith')][valid]
+            azimuth[valid] = grids[(detector, 'Azimuth')][valid]
+        view_bands[band] = (zenith, azimuth)
+    nan_grid = numpy.full((23, 23), numpy.nan)
+    return {'SZA': grids.get(('sun', 'Zenith'), nan_grid), 'SAA': grids.get(('sun', 'Azimuth'), nan_grid),
+            'view_bands': view_bands,
+            'sun_colstep': steps.get(('sun', 'COL_STEP'), 0.0), 'sun_rowstep': steps.get(('sun', 'ROW_STEP'), 0.0),
+            'view_colstep': steps.get(('view', 'COL_STEP'), 0.0), 'view_rowstep': steps.get(('view', 'ROW_STEP'), 0.0),
+            'geopositions': geopositions, 'nan_grid': nan_grid}
+
 # *** CHANGE: Removed resample_image() function as it is now redundant and caused memory bottlenecks ***
 
 #def extract_boa_add_offset_values(xml):
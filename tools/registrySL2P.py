@@ -0,0 +1,117 @@
+# registrySL2P.py
+
+import logging
+import os
+import numpy
+from tools import toolsNets
+from tools import convertNets
+from tools import dictionariesSL2P
+from tools import SL2PV0 as algorithm
+
+logger = logging.getLogger(__name__)
+
+# Process-wide registry of SL2P assets. Entries are populated lazily on first request and
+# kept for the lifetime of the process, so batch runs over many tiles only pay for loading
+# the networks of the collection(s) they actually use, once.
+# Networks and domains are read from the precompiled convertNets.NETS_FILE when it exists,
+# and otherwise built from the nets/*.pkl FeatureCollections; the file is ignored (with a
+# warning) when any of the pickles it was converted from changed since.
+_collectionOptions = {}
+_nets = {}
+_domains = {}
+_domainLUTs = {}
+_modelFingerprints = {}
+_netOptions = None
+_netsFile = None
+
+
+def get_net_options(variableName, imageCollectionName):
+    """Return the network options of a variable for a collection (see dictionariesSL2P.make_net_options)."""
+    global _netOptions
+    if _netOptions is None:
+        _netOptions = dictionariesSL2P.make_net_options()
+    return _netOptions[variableName][imageCollectionName]
+
+
+def get_collection_options(imageCollectionName):
+    """Return the collection options of imageCollectionName, loading only the assets of that collection."""
+    if imageCollectionName not in _collectionOptions:
+        collectionOptions = dictionariesSL2P.make_collection_options(algorithm, imageCollectionName)
+        _collectionOptions[imageCollectionName] = collectionOptions[imageCollectionName]
+    return _collectionOptions[imageCollectionName]
+
+
+def get_nets(imageCollectionName, variableName):
+    """
+    Return the (estimate, error) networks of a variable for a collection.
+    Each is the list of numNets networks built by toolsNets.makeNetVars and can be passed
+    directly to toolsNets.applyNet.
+    """
+    key = (imageCollectionName, variableName)
+    if key not in _nets and _load_nets_file():
+        _nets[key] = _netsFile[0][key]
+    if key not in _nets:
+        colOptions = get_collection_options(imageCollectionName)
+        netOptions = get_net_options(variableName, imageCollectionName)
+        numNets = len({k: v for k, v in (colOptions["Network_Ind"]['features'][0]['properties']).items() if k != 'Feature Index'})
+        _nets[key] = (toolsNets.makeNetVars(colOptions["Collection_SL2P"], numNets, netOptions['variable']-1),
+                      toolsNets.makeNetVars(colOptions["Collection_SL2Perrors"], numNets, netOptions['variable']-1))
+    return _nets[key]
+
+
+def get_domain(imageCollectionName):
+    """Return the sorted SL2P calibration domain codes (DomainCode) of a collection."""
+    if imageCollectionName not in _domains:
+        if _load_nets_file():
+            _domains[imageCollectionName] = _netsFile[1][imageCollectionName]
+        else:
+            colOptions = get_collection_options(imageCollectionName)
+            _domains[imageCollectionName] = numpy.sort(numpy.array([row['properties']['DomainCode'] for row in colOptions["sl2pDomain"]['features']]))
+    return _domains[imageCollectionName]
+
+
+def get_domain_lut(imageCollectionName, numBands):
+    """Return the domain lookup table of a collection (see SL2P.compileDomain) for numBands reflectance bands."""
+    key = (imageCollectionName, numBands)
+    if key not in _domainLUTs:
+        from tools import SL2P
+        _domainLUTs[key] = SL2P.compileDomain(get_domain(imageCollectionName), numBands)
+    return _domainLUTs[key]
+
+
+def get_model_fingerprint(imageCollectionName, variableName, compute):
+    """
+    Return compute(imageCollectionName, variableName), the fingerprint of the networks of a
+    variable (see fingerprintSL2P.model_fingerprint), computed once until clear().
+    """
+    key = (imageCollectionName, variableName)
+    if key not in _modelFingerprints:
+        _modelFingerprints[key] = compute(imageCollectionName, variableName)
+    return _modelFingerprints[key]
+
+
+def _load_nets_file():
+    global _netsFile
+    if _netsFile is None:
+        _netsFile = False
+        if os.path.exists(convertNets.NETS_FILE):
+            changed = convertNets.changed_sources(convertNets.NETS_FILE)
+            if changed:
+                logger.warning('%s is out of date (%s changed), using the pickles; rerun python -m tools.convertNets',
+                               convertNets.NETS_FILE, ', '.join(changed))
+            else:
+                _netsFile = convertNets.load_nets(convertNets.NETS_FILE)
+    return _netsFile
+
+
+def clear():
+    """Drop every cached entry (e.g. after the files in nets/ were updated)."""
+    global _netOptions, _netsFile
+    _collectionOptions.clear()
+    _nets.clear()
+    _domains.clear()
+    _domainLUTs.clear()
+    _netOptions = None
+    _netsFile = None
+    algorithm.load_asset.cache_clear()
+    _modelFingerprints.clear()
@@ -0,0 +1,90 @@
+# resampleSL2P.py
+
+# Resampling stage of the readers: every layer is brought onto the target pixel grid in one
+# GDAL call (decimated read when the grids line up, rasterio.warp.reproject otherwise), with
+# a resampling method chosen by the kind of layer:
+#   reflectance bands (B..)          average   (anti-aliased reduction, nodata excluded)
+#   angles and their cosines         bilinear
+#   classes / bitfields (SCL, QAI)   mode
+# A grid is a (transform, (rows, cols)) pair in the CRS of the source.
+# Warps are timed as the 'resample' stage of profileSL2P (decimated reads count as 'read').
+
+import numpy
+from affine import Affine
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.warp import reproject
+from rasterio.windows import from_bounds
+from rasterio.transform import array_bounds
+from tools import profileSL2P
+
+RESAMPLING = {'reflectance': Resampling.average, 'angle': Resampling.bilinear, 'class': Resampling.mode}
+
+
+def layer_kind(name):
+    """Return the RESAMPLING kind of an s2 layer name."""
+    if name in ('SCL', 'QAI'):
+        return 'class'
+    if name.startswith('B'):
+        return 'reflectance'
+    return 'angle'
+
+
+def target_grid(profile, res, window=None):
+    """
+    Return the grid at resolution res (map units) covering the raster described by profile,
+    anchored on its upper-left corner, or the part of it in window (rasterio Window in target
+    pixels). Pixels of the raster that do not fill a whole target pixel are dropped.
+    """
+    transform = profile['transform']
+    grid = Affine(res, transform.b, transform.c, transform.d, -res, transform.f)
+    shape = (int(profile['height'] * abs(transform.e) // res), int(profile['width'] * transform.a // res))
+    if window is not None:
+        grid = grid * Affine.translation(window.col_off, window.row_off)
+        shape = (int(window.height), int(window.width))
+    return grid, shape
+
+
+def read_to_grid(src, indexes, grid, kind, out=None, dtype=numpy.float32):
+    """
+    Read bands indexes (list) of an open dataset onto grid with the resampling of kind.
+    When the grid pixels are made of whole source pixels (e.g. 20m from 10m) this is a single
+    decimated read of the source window; otherwise the bands are warped with reproject.
+    Returns an (len(indexes), rows, cols) array (out if given).
+    """
+    transform, shape = grid
+    if out is None:
+        out = numpy.empty((len(indexes),) + tuple(shape), dtype=dtype)
+    window = from_bounds(*array_bounds(shape[0], shape[1], transform), transform=src.transform)
+    aligned = all(abs(value - round(value)) < 1e-6 for value in (window.col_off, window.row_off, window.width, window.height))
+    if aligned and transform.b == 0 and transform.d == 0:
+        src.read(indexes=indexes, out=out, window=window.round_offsets().round_lengths(), resampling=RESAMPLING[kind],
+                 boundless=window.col_off < 0 or window.row_off < 0 or window.col_off + window.width > src.width
+                 or window.row_off + window.height > src.height)
+    else:
+        with profileSL2P.stage('resample', out.size):
+            reproject(rasterio.band(src, indexes), out, src_transform=src.transform, src_crs=src.crs, src_nodata=src.nodata,
+                      dst_transform=transform, dst_crs=src.crs, dst_nodata=src.nodata, resampling=RESAMPLING[kind])
+    return out
+
+
+def resample_to_shape(array, shape, kind, dtype=None):
+    """
+    Resample a 2D array onto shape over the same extent (e.g. a 20m SCL onto a 10m band grid,
+    or a 23x23 angle grid onto the pixels of a tile) with GDAL and the resampling of kind.
+    """
+    array = numpy.asarray(array)
+    if array.dtype == numpy.int64 or array.dtype == bool:
+        array = array.astype(numpy.int32) # not GDAL data types
+    out = numpy.empty(tuple(shape), dtype=dtype or array.dtype)
+    if tuple(array.shape) == tuple(shape):
+        out[...] = array
+        return out
+    # any common extent will do: a nominal 1 km source grid in a UTM zone (GDAL loses precision
+    # with unit-sized pixels) and the same extent divided into shape pixels for the target
+    src_transform = Affine(1000., 0, 500000., 0, -1000., 5000000.)
+    dst_transform = Affine(1000. * array.shape[1] / shape[1], 0, 500000., 0, -1000. * array.shape[0] / shape[0], 5000000.)
+    with profileSL2P.stage('resample', out.size):
+        reproject(array, out, src_transform=src_transform, dst_transform=dst_transform, src_crs='EPSG:32633',
+                  dst_crs='EPSG:32633', resampling=RESAMPLING[kind])
+    return out
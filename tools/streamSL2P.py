@@ -0,0 +1,127 @@
+# streamSL2P.py
+
+# Block-wise processing of whole FORCE tiles: every chunk of the tile goes through
+# read -> prepare -> inference -> flags -> write before the next one is read, so the peak
+# memory is bounded by the chunk size instead of the tile size.
+
+import functools
+import logging
+import os
+import numpy
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from rasterio.windows import Window
+from tools import SL2P
+from tools import registrySL2P
+from tools import dictionariesSL2P
+from tools import write_sl2p_product
+from tools import profileSL2P
+from tools import cacheSL2P
+from tools.read_sentinel2_force_image import read_s2_force, read_force_profile
+
+logger = logging.getLogger(__name__)
+
+# default chunk edge in pixels: a 512x512 chunk keeps the hidden layers of the six
+# estimate and error nets of SL2P_multi around 100 MB
+CHUNK_SIZE = 512
+
+
+def iter_windows(profile, chunk_size=CHUNK_SIZE):
+    """Yield the windows of chunk_size x chunk_size pixels covering a raster described by profile."""
+    for row_off in range(0, profile['height'], chunk_size):
+        for col_off in range(0, profile['width'], chunk_size):
+            yield Window(col_off, row_off,
+                         min(chunk_size, profile['width'] - col_off),
+                         min(chunk_size, profile['height'] - row_off))
+
+
+def process_window(tile_dir, imageCollectionName, variables, window, backend='float64', cache_dir=None):
+    """
+    Read, prepare and run SL2P_multi on one window of a FORCE tile; returns (window, varmap).
+    With cache_dir the prepared window is taken from (or stored in) that cacheSL2P directory.
+    """
+    bands = registrySL2P.get_net_options(variables[0], imageCollectionName)['inputBands']
+    paths = [os.path.join(tile_dir, fn) for fn in os.listdir(tile_dir) if fn.endswith('.tif')]
+    sl2p_inp, mask, inputFlag, _ = cacheSL2P.prepared_input(
+        cache_dir, paths, lambda: read_s2_force(tile_dir, bands=bands, window=window), variables[0], imageCollectionName,
+        window=(window.col_off, window.row_off, window.width, window.height) if window is not None else None)
+    varmap = SL2P.SL2P_multi(sl2p_inp, imageCollectionName, variables, mask=mask, backend=backend, inputFlag=inputFlag)
+    # float32/uint8 halve what is sent back from a worker process
+    varmap = {key: value.astype(numpy.uint8 if 'Flag' in key else numpy.float32) for key, value in varmap.items()}
+    return window, varmap
+
+
+def init_worker(imageCollectionName, variables):
+    """Load the networks once per worker process (they stay in its registrySL2P)."""
+    for variableName in variables:
+        registrySL2P.get_nets(imageCollectionName, variableName)
+    registrySL2P.get_domain(imageCollectionName)
+
+
+def profiled(process, *args):
+    """Run process(*args) in a worker process; returns its result and the profileSL2P stages it recorded."""
+    return process(*args), profileSL2P.take_stages()
+
+
+def iter_results(tile_dir, imageCollectionName, variables, windows, workers=None, backend='float64',
+                 process=process_window):
+    """
+    Yield process(tile_dir, imageCollectionName, variables, window, backend) results for
+    windows (process_window by default), in this process or, with workers > 1, in a pool
+    of worker processes. At most 2 windows per worker are in flight, so the memory of the
+    parent stays bounded while results are written out. The profileSL2P stages of the
+    workers are merged into this process as their results arrive.
+    """
+    if not workers or workers <= 1:
+        for window in windows:
+            yield process(tile_dir, imageCollectionName, variables, window, backend)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(imageCollectionName, variables)) as pool:
+        pending = set()
+        for window in windows:
+            pending.add(pool.submit(profiled, process, tile_dir, imageCollectionName, variables, window, backend))
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield _merged(future)
+        for future in as_completed(pending):
+            yield _merged(future)
+
+
+def _merged(future):
+    result, stages = future.result()
+    profileSL2P.merge_stages(stages)
+    return result
+
+
+def run_sl2p_stream(tile_dir, imageCollectionName, outPrefix, variables=None, chunk_size=CHUNK_SIZE, workers=None,
+                    backend='float64', dtype='float32', compress='DEFLATE', pack_flags=True, cache_dir=None, tags=None):
+    """
+    Run SL2P on a FORCE tile directory chunk by chunk and write one product per variable
+    to outPrefix_<variable>_PRODUCTS.tif (see write_sl2p_product for the layout, dtype,
+    compress and pack_flags). With workers > 1 the chunks are processed in parallel by
+    that many worker processes (e.g. os.cpu_count()). backend selects the inference
+    kernel (see toolsNets.BACKENDS). cache_dir: optional cacheSL2P directory of the prepared
+    chunks, so reruns of the tile (e.g. for other variables) skip reading and preparation.
+    tags: optional {variable: product tags} (see write_sl2p_product.open_product).
+    Returns {variable: product path}.
+    """
+    if variables is None:
+        variables = list(dictionariesSL2P.make_outputParams().keys())
+    profile = read_force_profile(tile_dir)
+    products = {variableName: write_sl2p_product.open_product(write_sl2p_product.product_path(outPrefix, variableName),
+                                                              profile, variableName, dtype, compress, pack_flags,
+                                                              tags=(tags or {}).get(variableName))
+                for variableName in variables}
+    chunks = 0
+    try:
+        for window, varmap in iter_results(tile_dir, imageCollectionName, variables, iter_windows(profile, chunk_size),
+                                           workers, backend, functools.partial(process_window, cache_dir=cache_dir)):
+            for product in products.values():
+                write_sl2p_product.write_block(product, window, varmap)
+            chunks += 1
+    finally:
+        paths = {variableName: write_sl2p_product.close_product(product) for variableName, product in products.items()}
+    logger.info('Ran SL2P for %s on %s (%dx%d pixels, %d chunks)', ', '.join(variables), tile_dir,
+                profile['width'], profile['height'], chunks)
+    return paths
@@ -0,0 +1,129 @@
+# timeseriesSL2P.py
+
+# Time-series mode: SL2P over all dates of a FORCE datacube tile, written as per-pixel
+# temporal stacks. The tile is processed window by window and, within a window, date by
+# date, so every date of a window is read back to back with the networks loaded once
+# (see streamSL2P for the block-wise processing of a single date).
+#
+# For every variable three multiband GeoTIFFs are written, one band per date (the band
+# descriptions hold the dates):
+#   outPrefix_<variable>_TS.tif              estimates (write_sl2p_product encoding)
+#   outPrefix_<variable>_TS_uncertainty.tif  uncertainties
+#   outPrefix_<variable>_TS_quality.tif      uint8 quality bitfield (write_sl2p_product.FLAG_BITS)
+
+import numpy
+import rasterio
+from tools import SL2P
+from tools import registrySL2P
+from tools import dictionariesSL2P
+from tools import streamSL2P
+from tools import write_sl2p_product
+from tools import resampleSL2P
+from tools import profileSL2P
+from tools.batchSL2P import discover_inputs
+from tools.read_sentinel2_force_image import read_single_tif_xml_angles
+
+TS_LAYERS = ['', '_uncertainty', '_quality']
+
+
+def timeseries_path(outPrefix, variableName, layer=''):
+    return outPrefix + f"_{variableName}_TS{layer}.tif"
+
+
+def entries_from_datacube(tile_dir, safe_root):
+    """
+    Return the dates of a FORCE datacube tile directory (X*_Y*) as entries for
+    run_sl2p_timeseries, sorted by date: dicts with 'date', 'boa', 'qai' and 'safe' (the SAFE
+    product of the same date and mission under safe_root, holding the angles).
+    """
+    entries = [{'date': inp['date'], 'boa': inp['path'], 'qai': inp['qai'], 'safe': inp['safe']}
+               for inp in discover_inputs([tile_dir], safe_root) if inp['kind'] == 'boa']
+    missing = [entry['boa'] for entry in entries if entry['safe'] is None]
+    if missing:
+        raise FileNotFoundError('No SAFE product with the angles of %s under %s' % (missing, safe_root))
+    return sorted(entries, key=lambda entry: entry['date'])
+
+
+def timeseries_profile(entries, res=20):
+    """Return the profile at resolution res (20m) of the grid shared by the BOA files of entries (they must be on the same grid)."""
+    profiles = []
+    for entry in entries:
+        with rasterio.open(entry['boa']) as src:
+            profiles.append((src.crs, src.transform, src.width, src.height))
+            profile = src.profile
+    if len(set(profiles)) > 1:
+        raise ValueError('The BOA files of a time series must share their grid (CRS, transform and size)')
+    transform, shape = resampleSL2P.target_grid(profile, res)
+    profile.update({'width': shape[1], 'height': shape[0], 'transform': transform})
+    return profile
+
+
+def process_date(entries, imageCollectionName, variables, item, backend='float64'):
+    """Read, prepare and run SL2P_multi on one (window, date index) item; returns (item, varmap)."""
+    window, index = item
+    entry = entries[index]
+    bands = registrySL2P.get_net_options(variables[0], imageCollectionName)['inputBands']
+    s2 = read_single_tif_xml_angles(entry['boa'], entry['safe'], bands=bands, qai_path=entry.get('qai'), window=window)
+    sl2p_inp = SL2P.prepare_sl2p_inp(s2, variables[0], imageCollectionName)
+    mask = SL2P.make_valid_mask(s2, variables[0], imageCollectionName)
+    varmap = SL2P.SL2P_multi(sl2p_inp, imageCollectionName, variables, mask=mask, backend=backend)
+    varmap = {key: value.astype(numpy.uint8 if 'Flag' in key else numpy.float32) for key, value in varmap.items()}
+    return item, varmap
+
+
+def open_stacks(outPrefix, profile, variables, dates, dtype='float32', compress='DEFLATE'):
+    """Create the estimate, uncertainty and quality stacks of every variable; returns {variable: product}."""
+    stacks = {}
+    for variableName in variables:
+        layer_profile = write_sl2p_product.make_product_profile(profile, dtype, compress)
+        profiles = [layer_profile, layer_profile, dict(layer_profile, dtype='uint8', nodata=None, predictor=2)]
+        datasets = []
+        for layer, layer_profile in zip(TS_LAYERS, profiles):
+            dst = rasterio.open(timeseries_path(outPrefix, variableName, layer), 'w', **dict(layer_profile, count=len(dates)))
+            dst.descriptions = tuple(dates)
+            datasets.append(dst)
+        scale, offset = write_sl2p_product.product_scale(variableName) if dtype == 'int16' else (1., 0.)
+        for dst, band_offset in zip(datasets[:2], (offset, 0.)):
+            dst.scales = (scale,) * len(dates)
+            dst.offsets = (band_offset,) * len(dates)
+            dst.update_tags(scale_factor=scale, add_offset=band_offset)
+        datasets[2].update_tags(**{'bit_%d' % (bit.bit_length() - 1): name for name, bit in write_sl2p_product.FLAG_BITS.items()})
+        stacks[variableName] = {'datasets': datasets, 'dtype': dtype, 'scale': scale, 'offset': offset}
+    return stacks
+
+
+def write_date(stacks, window, index, varmap):
+    """Write the layers of one date (band index + 1) of every variable for a window."""
+    for variableName, stack in stacks.items():
+        estimate, uncertainty, quality = stack['datasets']
+        with profileSL2P.stage('write', varmap['sl2p_inputFlag'].size):
+            estimate.write(write_sl2p_product.encode(stack, varmap[variableName], stack['offset']), index + 1, window=window)
+            uncertainty.write(write_sl2p_product.encode(stack, varmap[variableName+'_uncertainty'], 0.), index + 1, window=window)
+            quality.write(write_sl2p_product.pack_flags(varmap['sl2p_inputFlag'], varmap[variableName+'_sl2p_outputFlag']),
+                          index + 1, window=window)
+
+
+def run_sl2p_timeseries(entries, outPrefix, variables=None, imageCollectionName='S2_SINGLE_TIF',
+                        chunk_size=streamSL2P.CHUNK_SIZE, workers=None, backend='float64', dtype='float32',
+                        compress='DEFLATE'):
+    """
+    Run SL2P over the dates of a datacube tile (entries, see entries_from_datacube) and write
+    one estimate, uncertainty and quality stack per variable (date x rows x cols). The same
+    window is processed for all dates before moving to the next one; with workers > 1 the
+    (window, date) items are processed by that many worker processes.
+    Returns {variable: [estimate, uncertainty, quality stack paths]}.
+    """
+    if variables is None:
+        variables = list(dictionariesSL2P.make_outputParams().keys())
+    profile = timeseries_profile(entries)
+    stacks = open_stacks(outPrefix, profile, variables, [entry['date'] for entry in entries], dtype, compress)
+    items = ((window, index) for window in streamSL2P.iter_windows(profile, chunk_size) for index in range(len(entries)))
+    try:
+        for (window, index), varmap in streamSL2P.iter_results(entries, imageCollectionName, variables, items,
+                                                               workers, backend, process=process_date):
+            write_date(stacks, window, index, varmap)
+    finally:
+        for stack in stacks.values():
+            for dst in stack['datasets']:
+                dst.close()
+    return {variableName: [timeseries_path(outPrefix, variableName, layer) for layer in TS_LAYERS] for variableName in variables}
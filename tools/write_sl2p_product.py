@@ -0,0 +1,159 @@
+# write_sl2p_product.py
+
+# Writer of SL2P products as tiled, compressed GeoTIFFs, fed block by block as the
+# pipeline produces them (see streamSL2P) or with a whole image at once (write_product).
+#
+# Product layout (pack_flags=True, default):
+#   band 1  estimate of the variable
+#   band 2  uncertainty of the estimate
+#   band 3  quality bitfield: bit 0 input out of the calibration domain (invalidInput),
+#           bit 1 estimate out of the nominal range (invalidOutput), bit 2 pixel masked
+# With pack_flags=False the 4-layer layout of the original notebooks is kept (input flag,
+# output flag as layers 3 and 4).
+# With dtype='int16' the estimate and uncertainty are stored as integers; the physical value
+# is stored * scale + offset, recorded as GDAL band scale/offset and as scale_factor/
+# add_offset tags (see product_scale).
+# A product is a dict holding the open dataset and its encoding, like the option dicts of
+# dictionariesSL2P.
+
+import os
+import numpy
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from tools import dictionariesSL2P
+from tools import profileSL2P
+
+FLAG_BITS = {'input': 1, 'output': 2, 'masked': 4}
+PRODUCT_NODATA = {'float32': -9999, 'int16': -32768}
+OVERVIEW_LEVELS = [2, 4, 8, 16]
+BLOCK_SIZE = 512
+
+
+def product_path(outPrefix, variableName):
+    return outPrefix + f"_{variableName}_PRODUCTS.tif"
+
+
+def product_scale(variableName):
+    """
+    Return the (scale, offset) of the int16 encoding of a variable: the nominal range of
+    make_outputParams spans 30000 steps centred on 0, so estimates up to about twice the
+    range outside it still fit in int16.
+    """
+    outputParams = dictionariesSL2P.make_outputParams()[variableName]
+    scale = (outputParams['outputMax'] - outputParams['outputOffset']) / 30000.
+    offset = (outputParams['outputMax'] + outputParams['outputOffset']) / 2.
+    return scale, offset
+
+
+def pack_flags(inputFlag, outputFlag):
+    """Pack the SL2P input and output flags (0 valid, 1 invalid, maskedFlag masked) into a uint8 bitfield."""
+    maskedFlag = dictionariesSL2P.make_mask_options()['maskedFlag']
+    masked = (inputFlag == maskedFlag) | (outputFlag == maskedFlag)
+    return ((inputFlag == 1) * FLAG_BITS['input'] | (outputFlag == 1) * FLAG_BITS['output']
+            | masked * FLAG_BITS['masked']).astype(numpy.uint8)
+
+
+def make_product_profile(profile, dtype='float32', compress='DEFLATE', pack_flags=True, blocksize=BLOCK_SIZE):
+    """Return the rasterio profile of a tiled, compressed product on the grid of profile."""
+    profile = dict(profile)
+    for key in ['blockxsize', 'blockysize', 'tiled', 'compress', 'interleave', 'predictor', 'photometric']:
+        profile.pop(key, None)
+    profile.update({
+        'driver': 'GTiff',
+        'count': 3 if pack_flags else 4,
+        'dtype': dtype,
+        'nodata': PRODUCT_NODATA[dtype],
+        'tiled': True,
+        'blockxsize': blocksize,
+        'blockysize': blocksize,
+        'compress': compress,
+        # horizontal differencing (integers) or floating point predictor
+        'predictor': 2 if dtype == 'int16' else 3,
+        'interleave': 'band',
+        'BIGTIFF': 'IF_SAFER',
+    })
+    return profile
+
+
+def open_product(path, profile, variableName, dtype='float32', compress='DEFLATE', pack_flags=True,
+                 blocksize=BLOCK_SIZE, cog=True, tags=None):
+    """
+    Create the product of variableName at path on the grid of profile (a rasterio profile)
+    and return it for write_block/close_product. compress is any GDAL GTiff compression
+    (DEFLATE, ZSTD, LZW...). With cog=True the blocks are written to a temporary file which
+    close_product rewrites with the overviews in front of the data (Cloud-Optimized layout).
+    tags: optional dataset tags (e.g. fingerprintSL2P.fingerprint_tags).
+    """
+    profile = make_product_profile(profile, dtype, compress, pack_flags, blocksize)
+    scale, offset = product_scale(variableName) if dtype == 'int16' else (1., 0.)
+    dst = rasterio.open(path + '.tmp.tif' if cog else path, 'w', **profile)
+    dst.descriptions = (variableName, variableName + '_uncertainty') + \
+        (('sl2p_quality',) if pack_flags else ('sl2p_inputFlag', 'sl2p_outputFlag'))
+    dst.scales = (scale, scale) + (1.,) * (profile['count'] - 2)
+    dst.offsets = (offset, 0.) + (0.,) * (profile['count'] - 2)
+    dst.update_tags(1, scale_factor=scale, add_offset=offset)
+    dst.update_tags(2, scale_factor=scale, add_offset=0.)
+    if pack_flags:
+        dst.update_tags(3, **{'bit_%d' % (bit.bit_length() - 1): name for name, bit in FLAG_BITS.items()})
+    if tags:
+        dst.update_tags(**tags)
+    return {'dst': dst, 'path': path, 'variable': variableName, 'dtype': dtype, 'scale': scale, 'offset': offset,
+            'pack_flags': pack_flags, 'compress': compress, 'blocksize': blocksize, 'cog': cog}
+
+
+def encode(product, values, offset):
+    """Encode estimate/uncertainty values (outputNodata where masked) in the product dtype."""
+    nodata = values == dictionariesSL2P.make_mask_options()['outputNodata']
+    if product['dtype'] == 'int16':
+        values = numpy.clip(numpy.rint((values - offset) / product['scale']), -32767, 32767)
+    values = values.astype(product['dtype'])
+    values[nodata] = PRODUCT_NODATA[product['dtype']]
+    return values
+
+
+def write_block(product, window, varmap):
+    """Write the layers of product['variable'] from an SL2P/SL2P_multi varmap for a window (None: whole image)."""
+    variableName = product['variable']
+    dst = product['dst']
+    outputFlag = varmap[variableName+'_sl2p_outputFlag'] if variableName+'_sl2p_outputFlag' in varmap else varmap['sl2p_outputFlag']
+    with profileSL2P.stage('write', outputFlag.size):
+        dst.write(encode(product, varmap[variableName], product['offset']), 1, window=window)
+        dst.write(encode(product, varmap[variableName+'_uncertainty'], 0.), 2, window=window)
+        if product['pack_flags']:
+            dst.write(pack_flags(varmap['sl2p_inputFlag'], outputFlag).astype(product['dtype']), 3, window=window)
+        else:
+            dst.write(varmap['sl2p_inputFlag'].astype(product['dtype']), 3, window=window)
+            dst.write(outputFlag.astype(product['dtype']), 4, window=window)
+
+
+def close_product(product, overviews=OVERVIEW_LEVELS, resampling=Resampling.nearest):
+    """
+    Build the overviews and close the product; returns its path. Nearest resampling keeps the
+    flag values valid in the overviews.
+    """
+    dst = product['dst']
+    overviews = [level for level in overviews if min(dst.width, dst.height) // level >= 1]
+    with profileSL2P.stage('write'):
+        if overviews:
+            dst.build_overviews(overviews, resampling)
+            dst.update_tags(ns='rio_overview', resampling=resampling.name)
+        tmp = dst.name
+        dst.close()
+        if product['cog']:
+            rasterio.shutil.copy(tmp, product['path'], driver='GTiff', tiled=True, copy_src_overviews=True,
+                                 blockxsize=product['blocksize'], blockysize=product['blocksize'],
+                                 compress=product['compress'], predictor=2 if product['dtype'] == 'int16' else 3,
+                                 BIGTIFF='IF_SAFER')
+            os.remove(tmp)
+    return product['path']
+
+
+def write_product(path, profile, variableName, varmap, **kwargs):
+    """Write a whole-image SL2P varmap as a product (kwargs as open_product); returns its path."""
+    product = open_product(path, profile, variableName, **kwargs)
+    try:
+        write_block(product, None, varmap)
+    finally:
+        path = close_product(product)
+    return path